@@ -5,6 +5,9 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 from dotenv import load_dotenv
 
+from backend.ai_services.llm_cache import llm_cache
+from backend.ai_services.openai_http import http_client
+
 load_dotenv()
 
 def map_description_to_filter(description: str):
@@ -51,7 +54,8 @@ def map_description_to_filter(description: str):
     ])
 
     # The model will generate a JSON string, which we parse into a Python dict
-    llm = ChatOpenAI(temperature=0, model="gpt-4-turbo-preview", openai_api_key=api_key)
+    llm = ChatOpenAI(temperature=0, model="gpt-4-turbo-preview", openai_api_key=api_key, http_client=http_client,
+                     cache=llm_cache)
     parser = JsonOutputParser()
     chain = prompt | llm | parser
 
@@ -0,0 +1,12 @@
+import os
+import tempfile
+from pathlib import Path
+
+from langchain_community.cache import SQLiteCache
+
+# On-disk cache for the deterministic (temperature=0) model calls that map a request to a
+# structured result: the filter mapper and the edit planner. It is passed to those models
+# only; conversational and sampled calls must not be answered from it.
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", str(Path(tempfile.gettempdir()) / "calhacks_llm_cache.db"))
+
+llm_cache = SQLiteCache(database_path=LLM_CACHE_PATH)
@@ -0,0 +1,10 @@
+import httpx
+
+# Every OpenAI client in the backend (raw SDK clients and LangChain's ChatOpenAI) sends its
+# requests through these two long-lived pools, so TLS handshakes are paid once per process
+# and concurrent requests are multiplexed over the same HTTP/2 connection. The SDK sets
+# its own per-request timeouts, so none is configured here.
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=300)
+
+http_client = httpx.Client(http2=True, limits=OPENAI_HTTP_LIMITS)
+async_http_client = httpx.AsyncClient(http2=True, limits=OPENAI_HTTP_LIMITS)
@@ -2,9 +2,11 @@ import os
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from backend.ai_services.openai_http import http_client
+
 load_dotenv()
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), http_client=http_client)
 
 def transcribe_audio(audio_path: str) -> str:
     """
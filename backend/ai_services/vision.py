@@ -1,17 +1,24 @@
 import os
 import base64
+import functools
 import tempfile
 from pathlib import Path
 from openai import OpenAI
-from moviepy.editor import VideoFileClip
+from moviepy.video.io.VideoFileClip import VideoFileClip
 from dotenv import load_dotenv
 
+from backend.ai_services.openai_http import http_client
+
 # Load environment variables from .env file
 load_dotenv()
 
+# Created once so repeated analyses reuse the same connection pool.
+client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), http_client=http_client)
+
 def analyze_video_content(video_path: str, num_frames: int = 5) -> str:
     """
     Analyzes the content of a video by extracting key frames and using a vision model.
+    Results are cached per file version, so re-analyzing an unchanged video is free.
 
     Args:
         video_path: The path to the video file.
@@ -20,8 +27,17 @@ def analyze_video_content(video_path: str, num_frames: int = 5) -> str:
     Returns:
         A descriptive summary of the video's content.
     """
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    
+    try:
+        stat = os.stat(video_path)
+        return _describe_video(video_path, stat.st_mtime_ns, stat.st_size, num_frames)
+    except Exception as e:
+        print(f"❌ Error during AI video content analysis: {e}")
+        return "Could not generate a content summary for the video."
+
+
+@functools.lru_cache(maxsize=128)
+def _describe_video(video_path: str, mtime_ns: int, size: int, num_frames: int) -> str:
+    """Asks the vision model to describe the video. The file's mtime and size are part of the cache key."""
     try:
         # Create a temporary directory to store frames
         with tempfile.TemporaryDirectory() as temp_dir:
@@ -66,9 +82,6 @@ def analyze_video_content(video_path: str, num_frames: int = 5) -> str:
         
         return response.choices[0].message.content
 
-    except Exception as e:
-        print(f"❌ Error during AI video content analysis: {e}")
-        return "Could not generate a content summary for the video."
     finally:
         if 'clip' in locals():
             clip.close()
@@ -1,11 +1,42 @@
 from typing import List
+import functools
 import json
+import logging
+import re
+import orjson
 from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, END
 from pathlib import Path
 
+from backend.ai_services.openai_http import async_http_client, http_client
 from backend.graph.state import GraphState
+from backend.graph.nodes.edit_query_parser import prefetch_edit_query
+from backend.graph.nodes.vision_analyzer import prefetch_video_analysis
+
+logger = logging.getLogger(__name__)
+
+# "tool_choice" is the first key of every reply, so it can be read off the stream early.
+_TOOL_CHOICE_RE = re.compile(r'"tool_choice"\s*:\s*"(\w+)"')
+
+
+@functools.lru_cache(maxsize=1)
+def _chat_model() -> ChatOpenAI:
+    """The chatbot model, created on first use and shared so its connection pool is reused."""
+    return ChatOpenAI(temperature=0, streaming=True, model_kwargs={"response_format": {"type": "json_object"}},
+                      http_client=http_client, http_async_client=async_http_client)
+
+
+def _start_successor(tool_choice: str, state: GraphState) -> None:
+    """
+    Kicks off the slow part of the node the router will pick for `tool_choice`
+    while the rest of the chatbot's reply is still streaming.
+    """
+    if tool_choice == "execute_edit":
+        prefetch_edit_query(state)
+    elif tool_choice == "contextual_question" and not state.get("video_description"):
+        prefetch_video_analysis(state)
+
 
 def chatbot(state: GraphState):
     """
@@ -34,7 +65,7 @@ def chatbot(state: GraphState):
             media_type = "audio" if ext in ['.mp3', '.wav', '.m4a', '.aac'] else "video"
             media_bin_context[vid_id] = {"filename": filename, "type": media_type}
     
-    print(f"[CHATBOT] Final media_bin_context: {json.dumps(media_bin_context, indent=2)}")
+    logger.debug("[CHATBOT] Final media_bin_context: %s", media_bin_context)
 
     # This is the new, powerful prompt for our chatbot.
     SYSTEM_PROMPT = f"""You are an expert AI video editing assistant. You are working in a multi-media environment with both videos and audio files.
@@ -80,35 +111,42 @@ Current project state:
 Your entire response must be only the JSON object.
 """
     
-    # Initialize the chatbot model
-    model = ChatOpenAI(temperature=0, streaming=True, model_kwargs={"response_format": {"type": "json_object"}})
+    model = _chat_model()
     
     # The full message history is in the state.
     messages = state.get("messages", [])
     if not messages:
         # This should not happen if called from main.py, but as a safeguard:
-        return {**state, "parsed_query": {"tool_choice": "answer_question", "data": {"question": "Hi"}}}
+        return {"parsed_query": {"tool_choice": "answer_question", "data": {"question": "Hi"}}}
 
     # The system prompt should always be the first message for consistent behavior.
     full_message_list = [SystemMessage(content=SYSTEM_PROMPT)] + messages
 
-    # Get the AI's response based on the full history
-    response = model.invoke(full_message_list)
+    # Get the AI's response based on the full history, streaming it so that the
+    # next node can start as soon as the tool choice is known.
+    chunks = []
+    successor_started = False
+    for chunk in model.stream(full_message_list):
+        chunks.append(chunk.content)
+        if not successor_started:
+            match = _TOOL_CHOICE_RE.search("".join(chunks))
+            if match:
+                successor_started = True
+                _start_successor(match.group(1), state)
+    content = "".join(chunks)
     
     try:
         # The response content should be a JSON string. We parse it.
-        parsed_response = json.loads(response.content)
+        parsed_response = orjson.loads(content)
         
         # The parsed response is now the primary output of this node.
         # It contains the 'tool_choice' and the 'data' for the next step.
         return {
-            **state,
             "parsed_query": parsed_response
         }
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         # Handle cases where the LLM output isn't valid JSON
         return {
-            **state,
             "error": "Failed to parse LLM response as JSON.",
             "result": {"message": "Sorry, I had trouble understanding that. Could you rephrase?"}
         }
@@ -1,29 +1,91 @@
-import json
 import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 
-from langchain_core.messages import SystemMessage
-from langchain_openai import ChatOpenAI
+import orjson
+from dotenv import load_dotenv
+from openai import OpenAI
+from pydantic import BaseModel, ConfigDict
 
+from backend.ai_services.openai_http import http_client
 from backend.graph.state import GraphState
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+load_dotenv()
+
 logger = logging.getLogger(__name__)
 
-def edit_query_parser(state: GraphState):
-    """
-    Parses a user's complex video editing query into a list of simple,
-    sequential natural language instructions.
-    """
-    logger.info("--- EDIT QUERY PARSER: Starting ---")
-    
+# Splitting a command into instructions is simple extraction, so the small model answers
+# first; the larger one is only asked when its reply is unusable (invalid or empty).
+PARSER_MODEL = "gpt-4o-mini"
+PARSER_FALLBACK_MODEL = "gpt-4o"
+
+
+class ParsedQuery(BaseModel):
+    """The parser's reply: the user's command split into simple instructions."""
+    model_config = ConfigDict(extra="forbid")
+
+    actions: List[str]
+
+
+# Schema generation is not free, so build the response format once.
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "ParsedQuery", "schema": ParsedQuery.model_json_schema(), "strict": True},
+}
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+
+# Shared across invocations, on the backend's shared HTTP/2 connection pool.
+client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+
+# Parse requests started early by the chatbot (see `prefetch_edit_query`), keyed by context message.
+# Bounded so that prefetches whose graph run never reaches this node cannot pile up.
+_MAX_PREFETCHED = 32
+_PARSE_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="edit-parse")
+_prefetched: "OrderedDict[str, Future]" = OrderedDict()
+_prefetch_lock = threading.Lock()
+
+
+# Everything that does not depend on the request lives in this fixed system prompt, so it
+# is a byte-identical prefix across calls and the provider can serve it from its prompt cache.
+# Kept terse: these tokens are paid on every parse.
+PARSER_SYSTEM_PROMPT = """You break a video editing command into a sequential list of simple natural language instructions for another AI to execute.
+
+Rules:
+1. Scope: if the user says "each video", "all videos" or "every video", write an instruction for EACH video in the media bin; otherwise every instruction applies to the active video.
+2. Taking the audio of one video and adding it to another is ONE instruction ("extract the audio from A and add it to B"), not separate extract and add steps.
+3. A step that continues a chain refers to the previous step's output ("... to the result of step N"), not to older steps unless necessary.
+4. Refer to files by their media bin filename (e.g. 'my_vacation.mp4'), never by their media ID.
+
+Reply with JSON only: {"actions": [instruction, ...]}
+
+Examples:
+- "Trim all videos from 4 seconds to 8 seconds." (bin: vid1.mp4, vid2.mp4) -> {"actions": ["trim video 'vid1.mp4' from 4 seconds to 8 seconds", "trim video 'vid2.mp4' from 4 seconds to 8 seconds"]}
+- "Trim the video from 00:04 to 00:08 and then apply a green filter." -> {"actions": ["trim the active video from 4 seconds to 8 seconds", "apply a green filter to the result of step 1"]}
+- "Concatenate video A and video B, then add a fade in, then add a fade out." -> {"actions": ["concatenate video A and video B", "add a fade in to the result of step 1", "add a fade out to the result of step 2"]}
+- "Take the audio from 'intro.mp4' and add it to 'main_video.mp4'." -> {"actions": ["extract the audio from 'intro.mp4' and add it to 'main_video.mp4'"]}
+"""
+
+# The per-request part, sent after the system prompt as the user message.
+PARSER_CONTEXT_TEMPLATE = """**Context:**
+- **User Command:** "{user_command}"
+- **Active Video ID:** "{active_video_id}"
+- **Media Bin:** {media_bin}
+"""
+
+
+def _build_prompt(state: GraphState) -> Optional[str]:
+    """Renders the per-request context message for a state, or returns None if there is nothing to parse."""
     media_bin = state.get("media_bin", {})
     active_video_id = state.get("active_video_id")
     messages = state.get("messages", [])
-    
+
     if not messages:
-        return {**state, "error": "No messages to parse."}
+        return None
 
     user_command = messages[-1].content
     
@@ -36,91 +98,92 @@ def edit_query_parser(state: GraphState):
         for media_id, path in media_bin.items()
     }
 
-    PROMPT = f"""You are an expert video editing assistant. Your job is to break down a user's command into a simple, sequential list of natural language instructions for another AI to execute.
+    return PARSER_CONTEXT_TEMPLATE.format(
+        user_command=user_command,
+        active_video_id=active_video_id,
+        # Compact and key-sorted, so the same media bin always renders the same prompt (and cache key).
+        media_bin=orjson.dumps(media_bin_context, option=orjson.OPT_SORT_KEYS).decode(),
+    )
+
+
+def _request_kwargs(prompt: str, model: str = PARSER_MODEL) -> dict:
+    return {
+        "model": model,
+        "temperature": 0,
+        "messages": [
+            {"role": "system", "content": PARSER_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ],
+        "response_format": _RESPONSE_FORMAT,
+    }
 
-**Primary Directive: Determine the Scope**
-1.  **Multi-Video Command:** If the user says "each video," "all videos," or "every video," generate an action for EACH video in the media bin.
-2.  **Single-Video Command:** Otherwise, all actions apply to the active video.
 
-**Combo Action Recognition:**
-- If the user asks to take audio from one video and add it to another, this is a SINGLE action.
-- Your output should be one combined instruction, like "extract audio from video A and add it to video B".
-- Do NOT break this into separate "extract" and "add" steps.
+def _parse_actions(response) -> Optional[List[str]]:
+    """Returns the instructions in a model response, or None if they are unusable."""
+    try:
+        # The schema is enforced server-side, so this only fails on refusals or truncation.
+        nl_actions = ParsedQuery.model_validate_json(response.choices[0].message.content or "").actions
+    except ValueError as e:
+        logger.warning("Failed to parse %s response: %s", response.model, e)
+        return None
+    return nl_actions or None
 
-**Response Format:**
-- Your output MUST be a JSON object with a single key "actions" containing a list of strings.
-- Each string in the list is one simple, clear instruction for the next AI.
-- For sequential actions, you MUST explicitly reference the output of the PREVIOUS step (e.g., "apply a green filter to the result of step 1", "add fade out to the result of step 2"). DO NOT reference older steps in the chain unless absolutely necessary.
 
-**CRITICAL RULE:**
-- You MUST use the descriptive filenames (e.g., 'my_vacation.mp4', 'intro_audio.mp3') from the Media Bin context when referring to files.
-- Do NOT use the long, random-looking media IDs in your output.
+def _handle_actions(nl_actions: Optional[List[str]], model: str) -> dict:
+    """Turns the parsed instructions into the node's state update."""
+    if nl_actions is None:
+        logger.error("No usable parse from %s or %s.", PARSER_MODEL, PARSER_FALLBACK_MODEL)
+        return {"error": "Failed to parse the editing command."}
+    logger.info("Successfully parsed into %d natural language actions (answered by %s).", len(nl_actions), model)
+    return {"parsed_actions": nl_actions}
+
+
+def _parse_one(prompt: str) -> Tuple[str, Optional[List[str]]]:
+    """Parses one query, escalating to the fallback model if needed. Returns (answering model, actions)."""
+    nl_actions = _parse_actions(client.chat.completions.create(**_request_kwargs(prompt)))
+    if nl_actions is not None:
+        return PARSER_MODEL, nl_actions
+    logger.info("Escalating parse to %s.", PARSER_FALLBACK_MODEL)
+    return PARSER_FALLBACK_MODEL, _parse_actions(client.chat.completions.create(**_request_kwargs(prompt, PARSER_FALLBACK_MODEL)))
+
+
+def prefetch_edit_query(state: GraphState) -> None:
+    """
+    Starts the parse request for `state` in the background. The chatbot calls this
+    as soon as it knows the query is an edit, so the request overlaps with the rest
+    of the chatbot's streamed reply; `edit_query_parser` then picks up the result.
+    """
+    prompt = _build_prompt(state)
+    if prompt is None:
+        return
+
+    with _prefetch_lock:
+        if prompt in _prefetched:
+            return
+        _prefetched[prompt] = _PARSE_POOL.submit(_parse_one, prompt)
+        while len(_prefetched) > _MAX_PREFETCHED:
+            _prefetched.popitem(last=False)
+
+
+def edit_query_parser(state: GraphState):
+    """
+    Parses a user's complex video editing query into a list of simple,
+    sequential natural language instructions.
+    """
+    logger.info("--- EDIT QUERY PARSER: Starting ---")
+
+    prompt = _build_prompt(state)
+    if prompt is None:
+        return {"error": "No messages to parse."}
+
+    with _prefetch_lock:
+        pending = _prefetched.pop(prompt, None)
 
-**Context:**
-- **User Command:** "{user_command}"
-- **Active Video ID:** "{active_video_id}"
-- **Media Bin:** {json.dumps(media_bin_context, indent=2)}
-
-**Example 1:**
-- User Command: "Trim all videos from 4 seconds to 8 seconds."
-- (Assuming the Media Bin contains videos with filenames "vid1.mp4" and "vid2.mp4")
-- **Your JSON Output:**
-  {{
-    "actions": [
-      "trim video 'vid1.mp4' from 4 seconds to 8 seconds",
-      "trim video 'vid2.mp4' from 4 seconds to 8 seconds"
-    ]
-  }}
-
-**Example 2:**
-- User Command: "Trim the video from 00:04 to 00:08 and then apply a green filter."
-- **Your JSON Output:**
-  {{
-    "actions": [
-      "trim the active video from 4 seconds to 8 seconds",
-      "apply a green filter to the result of step 1"
-    ]
-  }}
-         
-**Example 3 (Complex Chain):**
-- User Command: "Concatenate video A and video B, then add a fade in, then add a fade out."
-- **Your JSON Output:**
- {{
-   "actions": [
-     "concatenate video A and video B",
-     "add a fade in to the result of step 1",
-     "add a fade out to the result of step 2"
-   ]
- }}
-
-**Example 4 (Combo Action):**
-- User Command: "Take the audio from 'intro.mp4' and add it to 'main_video.mp4'."
-- **Your JSON Output:**
- {{
-   "actions": [
-     "extract the audio from 'intro.mp4' and add it to 'main_video.mp4'"
-   ]
- }}
-
-Now, generate the JSON output for the user's command.
-"""
-    
-    model = ChatOpenAI(temperature=0, model="gpt-4-turbo-preview", model_kwargs={"response_format": {"type": "json_object"}})
-    
     try:
-        response = model.invoke([SystemMessage(content=PROMPT)])
-        parsed_response = json.loads(response.content)
-        nl_actions = parsed_response.get("actions", [])
-        
-        if not isinstance(nl_actions, list) or not all(isinstance(i, str) for i in nl_actions):
-            raise ValueError("AI did not return a valid list of action strings.")
-            
-        logger.info(f"Successfully parsed into {len(nl_actions)} natural language actions.")
-        return {**state, "parsed_actions": nl_actions}
-
-    except (json.JSONDecodeError, ValueError) as e:
-        logger.error(f"Failed to parse AI response: {e}")
-        return {**state, "error": "Failed to parse the editing command."}
+        model, nl_actions = pending.result() if pending is not None else _parse_one(prompt)
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
-        return {**state, "error": "An unexpected error occurred during parsing."}
+        return {"error": "An unexpected error occurred during parsing."}
+
+    return _handle_actions(nl_actions, model)
+
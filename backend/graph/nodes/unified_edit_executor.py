@@ -1,19 +1,577 @@
-import json
+import functools
+import hashlib
 import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import ChainMap
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Optional
+from types import MappingProxyType
+from typing import Any, Callable, List, Dict, Final, Literal, Mapping, MutableMapping, Optional, Set, Tuple
 import re
 
-from langchain_core.messages import AIMessage, SystemMessage
-from langchain_core.tools import tool
+import orjson
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable
+from langchain_core.utils.function_calling import convert_to_openai_tool
 from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, ConfigDict
 
+from backend.ai_services.llm_cache import llm_cache
+from backend.ai_services.openai_http import async_http_client, http_client
 from backend.graph.state import GraphState
 from backend.video_engine import tools as video_tools
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+_PLACEHOLDER_RE = re.compile(r"\{\{result_of_step_(\d+)\}\}")
+_STEP_REFERENCE_RE = re.compile(r"(?:result of step|temp_result_)\s*(\d+)", re.IGNORECASE)
+
+# Use the tools directly from the video_engine, looked up by name. Built once at import.
+TOOL_MAP: Final[Mapping[str, Any]] = MappingProxyType({t.name: t for t in (
+    video_tools.trim_video,
+    video_tools.add_text_to_video,
+    video_tools.apply_filter_to_video,
+    video_tools.change_video_speed,
+    video_tools.concatenate_videos,
+    video_tools.extract_audio,
+    video_tools.add_audio_to_video,
+    video_tools.extract_and_add_audio,
+)})
+
+# The planner only turns instructions into tool calls, so a small, fast model is enough;
+# the larger one is used when its reply can't be parsed.
+PLANNER_MODEL = "gpt-4o-mini"
+PLANNER_FALLBACK_MODEL = "gpt-4-turbo-preview"
+
+# Arguments the executor fills in itself, hidden from the planner.
+_EXECUTOR_ARGS = frozenset({"media_bin", "stream_copy"})
+
+
+def _planner_tool_schema(tool) -> Dict[str, Any]:
+    schema = convert_to_openai_tool(tool)
+    parameters = schema["function"]["parameters"]
+    parameters["properties"] = {k: v for k, v in parameters["properties"].items() if k not in _EXECUTOR_ARGS}
+    parameters["required"] = [k for k in parameters.get("required", []) if k not in _EXECUTOR_ARGS]
+    return schema
+
+
+PLANNER_TOOLS = [_planner_tool_schema(t) for t in TOOL_MAP.values()]
+
+
+class PlannedToolCall(BaseModel):
+    """One tool call of the plan, as returned by the planner model."""
+    model_config = ConfigDict(extra="forbid")
+
+    step: int = 0
+    action: Literal[tuple(TOOL_MAP)]
+    args: Dict[str, Any]
+
+
+class PlannedToolCalls(BaseModel):
+    tool_calls: List[PlannedToolCall]
+
+
+@functools.lru_cache(maxsize=None)
+def _planner(model_name: str) -> Runnable:
+    """The planner model with the tools bound, created once per model and reused across requests."""
+    model = ChatOpenAI(temperature=0, model=model_name, http_client=http_client, http_async_client=async_http_client,
+                       cache=llm_cache)
+    return model.bind_tools(PLANNER_TOOLS, tool_choice="required")
+
+# Single-input edits that `video_tools.apply_fused_edits` can run together in one ffmpeg pass.
+FUSABLE_TOOLS = frozenset({"trim_video", "change_video_speed", "add_text_to_video"})
+
+# Deterministic video edits whose outputs are reused when the same edit is made
+# again on unchanged inputs. Filters are left out: their output depends on a model's
+# mapping of the free-text description, which the memo key can't capture.
+MEMOIZABLE_TOOLS = FUSABLE_TOOLS | {"concatenate_videos", "add_audio_to_video", "extract_and_add_audio"}
+# Arguments naming input media; they are keyed by file version instead of by ID. The
+# order fixes each input's role in the key, and the first input names the output file.
+_MEDIA_ID_ARGS = ("active_video_id", "video_ids", "video_id", "destination_video_id", "audio_id", "source_video_id")
+
+
+def _source_paths(tool_args: Dict[str, Any], media: Mapping[str, str]) -> Optional[List[str]]:
+    """The input files of a tool call, or None if some ID isn't in the media bin."""
+    ids = []
+    for arg in _MEDIA_ID_ARGS:
+        value = tool_args.get(arg)
+        if value is not None:
+            ids.extend(value if isinstance(value, list) else [value])
+    paths = [media.get(media_id) for media_id in ids]
+    return paths if paths and None not in paths else None
+
+
+def _memo_params(tool_args: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in tool_args.items() if k not in _MEDIA_ID_ARGS}
+
+# Every tool call decodes and re-encodes video, so the number running at once (across
+# concurrent requests) is capped to keep encoders from fighting over the same cores. The
+# permits live with the tools, which take spare ones for encodes they run in parallel.
+EDIT_CONCURRENCY = video_tools.EDIT_CONCURRENCY
+_EDIT_SEMAPHORE = video_tools.EDIT_SEMAPHORE
+# Runs the independent units of a stage side by side.
+_STEP_POOL = ThreadPoolExecutor(max_workers=EDIT_CONCURRENCY, thread_name_prefix="edit-step")
+
+# Planned tool calls are cached on disk, keyed by the instructions and the media bin
+# they refer to, so repeated edits skip the LLM round trip.
+TOOL_CALL_CACHE_PATH = Path(os.environ.get("TOOL_CALL_CACHE_PATH", Path(tempfile.gettempdir()) / "calhacks_tool_call_cache.sqlite3"))
+TOOL_CALL_CACHE_TTL = 7 * 24 * 60 * 60
+TOOL_CALL_CACHE_MAX_ENTRIES = 10_000
+
+_tool_call_cache: Optional[sqlite3.Connection] = None
+_tool_call_cache_lock = threading.Lock()
+
+
+def _tool_call_cache_connection() -> sqlite3.Connection:
+    global _tool_call_cache
+    if _tool_call_cache is None:
+        _tool_call_cache = sqlite3.connect(TOOL_CALL_CACHE_PATH, check_same_thread=False)
+        _tool_call_cache.execute(
+            "CREATE TABLE IF NOT EXISTS tool_calls (key TEXT PRIMARY KEY, content TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+    return _tool_call_cache
+
+
+def _tool_call_cache_key(instructions: List[str], active_video_id: Optional[str], media_bin_context: str) -> str:
+    payload = orjson.dumps([instructions, active_video_id, media_bin_context])
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _cached_tool_calls(key: str) -> Optional[str]:
+    """Returns the cached planner reply for `key`, if there is a fresh one."""
+    try:
+        with _tool_call_cache_lock:
+            row = _tool_call_cache_connection().execute(
+                "SELECT content FROM tool_calls WHERE key = ? AND created_at > ?",
+                (key, time.time() - TOOL_CALL_CACHE_TTL),
+            ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Tool call cache lookup failed: {e}")
+        return None
+    return row[0] if row else None
+
+
+def _store_tool_calls(key: str, content: str) -> None:
+    try:
+        with _tool_call_cache_lock:
+            connection = _tool_call_cache_connection()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO tool_calls (key, content, created_at) VALUES (?, ?, ?)",
+                    (key, content, time.time()),
+                )
+                # Keep only the newest entries.
+                connection.execute(
+                    "DELETE FROM tool_calls WHERE key NOT IN (SELECT key FROM tool_calls ORDER BY created_at DESC LIMIT ?)",
+                    (TOOL_CALL_CACHE_MAX_ENTRIES,),
+                )
+    except sqlite3.Error as e:
+        logger.warning(f"Tool call cache update failed: {e}")
+
+
+def _substitute_placeholders(value: Any, resolve: Callable[[int], Optional[str]]) -> Any:
+    """
+    Replaces `{{result_of_step_N}}` placeholders in tool arguments, walking nested
+    dicts and lists. `resolve` maps a step number to the media ID to use; when it
+    returns None the placeholder is left untouched.
+    """
+    if isinstance(value, str):
+        if "{{" not in value:
+            return value
+        # Media-ID arguments are usually exactly one placeholder.
+        whole = _PLACEHOLDER_RE.fullmatch(value)
+        if whole:
+            return resolve(int(whole.group(1))) or value
+        def replace(match):
+            return resolve(int(match.group(1))) or match.group(0)
+        return _PLACEHOLDER_RE.sub(replace, value)
+    if isinstance(value, dict):
+        return {k: _substitute_placeholders(v, resolve) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_substitute_placeholders(v, resolve) for v in value]
+    return value
+
+
+# Static part of the planner prompt. It never changes between requests, so it is sent
+# first and OpenAI's automatic prompt caching can reuse it.
+TOOL_CALLER_SYSTEM_PROMPT = """You are a precise AI tool-calling assistant. Your ONLY job is to convert a numbered list of natural language instructions into tool calls.
+
+**CRITICAL RULES:**
+1.  Call exactly one tool per instruction, in the order the instructions are numbered. Do not reply with text.
+2.  If an instruction refers to a result from a previous step (e.g., "the edited video"), you MUST use the placeholder `{{result_of_step_N}}` for the ID.
+3.  If an instruction mentions a filename (e.g., "video1.mp4"), find its ID from the Media Bin context and use the ID.
+4.  If no specific video is mentioned and it's the first step, use the `active_video_id` for the `active_video_id` parameter.
+"""
+
+# Per-request part of the planner prompt, sent as the user message.
+TOOL_CALLER_CONTEXT_TEMPLATE = """**Context:**
+- **Instructions to parse:**
+{instructions}
+- **Active Video ID:** "{active_video_id}"
+- **Media Bin (filename: id):** {media_bin_context}
+"""
+
+
+# Fast path: instructions phrased the way the edit query parser usually writes them are
+# turned into tool calls directly, without asking the model. An instruction that names no
+# video applies to the active video in step 1 and to the previous step's result after that.
+_TARGET_STEP_RE = re.compile(r"(?:the )?result of step (\d+)", re.IGNORECASE)
+_TARGET_FILE_RE = re.compile(r"(?:the )?(?:video |audio |clip )?['\"]([^'\"]+)['\"]", re.IGNORECASE)
+_ACTIVE_VIDEO_TARGETS = frozenset({"the video", "the active video", "the current video", "this video", "it"})
+_SECONDS = r"(\d+(?:\.\d+)?)\s*(?:seconds?|secs?|s)?"
+
+FAST_PATH_PATTERNS = (
+    (re.compile(rf"trim(?: (?P<target>.+?))? from {_SECONDS} to {_SECONDS}", re.IGNORECASE), "trim_video",
+     lambda m, target: {"active_video_id": target, "start_time": float(m.group(2)), "end_time": float(m.group(3))}),
+    (re.compile(r"(?:speed up|change the speed(?: of)?)(?: (?P<target>.+?))? (?:by|to) (?:a factor of )?(\d+(?:\.\d+)?)\s*x?", re.IGNORECASE), "change_video_speed",
+     lambda m, target: {"active_video_id": target, "speed_factor": float(m.group(2))}),
+    (re.compile(r"extract (?:the )?audio(?: from (?P<target>.+))?", re.IGNORECASE), "extract_audio",
+     lambda m, target: {"active_video_id": target}),
+)
+_CONCATENATE_RE = re.compile(r"concatenate (?P<targets>.+)", re.IGNORECASE)
+_LIST_SEPARATOR_RE = re.compile(r"\s*,\s*(?:and\s+)?|\s+and\s+", re.IGNORECASE)
+
+
+def _resolve_target(text: str, media_ids: Mapping[str, str], active_video_id: Optional[str]) -> Optional[str]:
+    """Maps a video reference in an instruction to a media ID or step placeholder."""
+    text = text.strip().rstrip(".")
+    step_match = _TARGET_STEP_RE.fullmatch(text)
+    if step_match:
+        return f"{{{{result_of_step_{step_match.group(1)}}}}}"
+    file_match = _TARGET_FILE_RE.fullmatch(text)
+    if file_match:
+        return media_ids.get(file_match.group(1))
+    if text.lower() in _ACTIVE_VIDEO_TARGETS:
+        return active_video_id
+    return None
+
+
+def _fast_parse(instruction: str, step: int, media_ids: Mapping[str, str], active_video_id: Optional[str]) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """Parses a simple instruction (the `step`-th) without the model. Returns None if it isn't recognized."""
+    instruction = instruction.strip().rstrip(".")
+    concatenate_match = _CONCATENATE_RE.fullmatch(instruction)
+    if concatenate_match:
+        video_ids = [_resolve_target(t, media_ids, active_video_id) for t in _LIST_SEPARATOR_RE.split(concatenate_match.group("targets"))]
+        if len(video_ids) < 2 or None in video_ids:
+            return None
+        return "concatenate_videos", {"video_ids": video_ids}
+
+    for pattern, tool_name, build_args in FAST_PATH_PATTERNS:
+        match = pattern.fullmatch(instruction)
+        if match:
+            if match.group("target") is None:
+                target = active_video_id if step == 1 else f"{{{{result_of_step_{step - 1}}}}}"
+            else:
+                target = _resolve_target(match.group("target"), media_ids, active_video_id)
+            return (tool_name, build_args(match, target)) if target else None
+    return None
+
+
+def _plan_tool_calls(instructions: List[str], active_video_id: Optional[str], media_ids: Mapping[str, str],
+                     on_call: Optional[Callable[[int, str, Dict[str, Any]], None]] = None) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Turns every instruction into a (tool_name, tool_args) call, in step order.
+    Simple instructions are parsed locally; the rest go to the model in a single request.
+    `on_call(step, tool_name, tool_args)`, if given, is told about each call as soon as it
+    is known, before the rest of the plan is finished.
+    """
+    planned = [_fast_parse(instruction, step, media_ids, active_video_id) for step, instruction in enumerate(instructions, start=1)]
+    misses = [step for step, call in enumerate(planned, start=1) if call is None]
+    logger.info("Fast path parsed %d/%d instructions", len(instructions) - len(misses), len(instructions))
+
+    if on_call is not None:
+        for step, call in enumerate(planned, start=1):
+            if call is not None:
+                on_call(step, *call)
+
+    if misses:
+        numbered_instructions = [f"{step}. {instructions[step - 1]}" for step in misses]
+        media_bin_context = orjson.dumps(media_ids, option=orjson.OPT_SORT_KEYS).decode()
+
+        streamed_call = None
+        if on_call is not None:
+            def streamed_call(index: int, call: PlannedToolCall) -> None:
+                # The model answers the instructions in the order they were sent.
+                if index < len(misses):
+                    on_call(misses[index], call.action, call.args)
+
+        calls = _model_tool_calls(numbered_instructions, active_video_id, media_bin_context, streamed_call)
+        for step, call in zip(misses, calls):
+            planned[step - 1] = call
+    return planned
+
+
+def _request_tool_calls(model: Runnable, messages: List[Any], on_call: Optional[Callable[[int, PlannedToolCall], None]]) -> str:
+    """
+    Streams the model's tool calls and returns them as `{"tool_calls": [...]}` JSON.
+    `on_call(index, call)` receives each call once the model has moved on to the next one.
+    """
+    gathered = None
+    emitted = 0
+    for chunk in model.stream(messages):
+        gathered = chunk if gathered is None else gathered + chunk
+        if on_call is None:
+            continue
+        # A call's arguments are complete once the next call has started.
+        while len(gathered.tool_call_chunks) > emitted + 1:
+            tool_call = gathered.tool_call_chunks[emitted]
+            try:
+                call = PlannedToolCall(action=tool_call["name"], args=orjson.loads(tool_call["args"] or "{}"))
+            except ValueError:
+                # Malformed calls are caught again when the whole reply is validated.
+                call = None
+            if call is not None:
+                on_call(emitted, call)
+            emitted += 1
+
+    tool_calls = [
+        {"step": index, "action": tool_call["name"], "args": orjson.loads(tool_call["args"] or "{}")}
+        for index, tool_call in enumerate(gathered.tool_call_chunks if gathered is not None else [], start=1)
+    ]
+    return orjson.dumps({"tool_calls": tool_calls}).decode()
+
+
+def _parse_tool_calls(content: str, expected: int) -> List[Tuple[str, Dict[str, Any]]]:
+    """Validates a `{"tool_calls": [...]}` reply. Raises ValueError if it doesn't match the schema."""
+    tool_calls = PlannedToolCalls.model_validate_json(content).tool_calls
+    if len(tool_calls) != expected:
+        raise ValueError(f"Expected {expected} tool calls, got {len(tool_calls)}.")
+    return [(call.action, call.args) for call in sorted(tool_calls, key=lambda call: call.step)]
+
+
+def _model_tool_calls(numbered_instructions: List[str], active_video_id: Optional[str], media_bin_context: str,
+                      on_call: Optional[Callable[[int, PlannedToolCall], None]] = None) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Asks the model (or the cache) for the tool calls of the given numbered instructions.
+    The reply is streamed, and `on_call(index, call)` receives each call as it completes.
+    If the fast planner model's reply can't be used, the larger fallback model is asked instead.
+    """
+    cache_key = _tool_call_cache_key(numbered_instructions, active_video_id, media_bin_context)
+    content = _cached_tool_calls(cache_key)
+    if content is not None:
+        try:
+            return _parse_tool_calls(content, len(numbered_instructions))
+        except ValueError:
+            logger.warning("Ignoring a cached plan that no longer validates.")
+
+    context = TOOL_CALLER_CONTEXT_TEMPLATE.format(
+        instructions="\n".join(numbered_instructions),
+        active_video_id=active_video_id,
+        media_bin_context=media_bin_context
+    )
+    messages = [SystemMessage(content=TOOL_CALLER_SYSTEM_PROMPT), HumanMessage(content=context)]
+    try:
+        content = _request_tool_calls(_planner(PLANNER_MODEL), messages, on_call)
+        planned = _parse_tool_calls(content, len(numbered_instructions))
+    except Exception as e:
+        logger.warning(f"{PLANNER_MODEL} did not produce a usable plan ({e}); retrying with {PLANNER_FALLBACK_MODEL}.")
+        content = _request_tool_calls(_planner(PLANNER_FALLBACK_MODEL), messages, None)
+        planned = _parse_tool_calls(content, len(numbered_instructions))
+
+    _store_tool_calls(cache_key, content)
+    return planned
+
+
+def _invoke_tool(tool_name: str, tool_args: Dict[str, Any], media_bin: MutableMapping[str, str]) -> str:
+    """Invokes a tool with the given media bin and returns the path it produced."""
+    logger.debug("Dispatching tool call: %s(%s)", tool_name, tool_args)
+    tool_function = TOOL_MAP[tool_name]
+    # This function invokes the tool and handles the result.
+    with _EDIT_SEMAPHORE:
+        result_from_tool = tool_function.invoke({**tool_args, "media_bin": media_bin})
+
+    # --- Robust Result Handling ---
+    if tool_function.name == "extract_audio":
+        try:
+            audio_info = orjson.loads(result_from_tool)
+            result_path = audio_info["output_path"]
+            new_audio_id = audio_info["audio_id"]
+            media_bin[new_audio_id] = result_path # Manually update the media bin
+            logger.debug("Handled extract_audio output. Path: %s, New ID: %s", result_path, new_audio_id)
+            return result_path
+        except (orjson.JSONDecodeError, KeyError):
+            logger.error(f"Could not parse result from extract_audio: {result_from_tool}")
+            return result_from_tool # Fallback
+    # For all other tools, the result is assumed to be a direct file path
+    return result_from_tool
+
+
+def _run_chain(calls: List[Tuple[str, Dict[str, Any]]], media_bin: MutableMapping[str, str]) -> str:
+    """
+    Runs a fused unit's steps one tool call at a time, each on the previous one's output.
+    Used when the single ffmpeg pass fails; the steps in between are deleted once consumed.
+    """
+    result_path = _invoke_tool(*calls[0], media_bin)
+    for index, (tool_name, tool_args) in enumerate(calls[1:], start=1):
+        if result_path.lower().startswith("error:"):
+            break
+        previous_path = result_path
+        previous_id = f"fused_step_{index}"
+        media_bin[previous_id] = previous_path
+        result_path = _invoke_tool(tool_name, _substitute_placeholders(tool_args, lambda step: previous_id), media_bin)
+        try:
+            os.remove(previous_path)
+        except OSError:
+            pass
+    return result_path
+
+
+def _edit_response(final_outputs: List[str]) -> Dict[str, Any]:
+    """Builds the node's state update announcing the finished video(s)."""
+    # --- FINAL RESPONSE ---
+    # The `output_files` field will now be populated for the frontend to render.
+    final_names = [os.path.basename(p) if p else None for p in final_outputs]
+    
+    if len(final_outputs) > 1:
+        final_output_urls = [f"/outputs/{name}" for name in final_names]
+        final_message = f"Successfully created {len(final_outputs)} new videos. They have been added to your media bin."
+        return {
+            "output_files": final_outputs,
+            "messages": [AIMessage(
+                content=final_message,
+                additional_kwargs={"output_urls": final_output_urls}
+            )]
+        }
+    
+    # Single output case remains the same
+    final_name = final_names[0]
+    output_url = f"/outputs/{final_name}" if final_name else None
+    
+    final_message = "Video editing complete! Your new video is ready."
+    
+    return {
+        "output_files": final_outputs,
+        "messages": [AIMessage(
+            content=final_message,
+            additional_kwargs={"output_url": output_url, "filename": final_name}
+        )]
+    }
+
+
+def _referenced_steps(value: Any) -> Set[int]:
+    """Returns the steps whose results are referenced by placeholders in a tool call's arguments."""
+    if isinstance(value, str):
+        return {int(step) for step in _PLACEHOLDER_RE.findall(value)}
+    if isinstance(value, dict):
+        return set().union(*map(_referenced_steps, value.values()))
+    if isinstance(value, list):
+        return set().union(*map(_referenced_steps, value))
+    return set()
+
+
+def _schedule(tool_calls: List[Tuple[str, Dict[str, Any]]], dependencies: List[Set[int]]) -> List[List[List[int]]]:
+    """
+    Groups the planned steps into stages that can run one after another. Each stage
+    is a list of units that don't depend on each other; a unit is a list of steps,
+    either a single step or a chain of fusable steps where each one only feeds the next.
+    """
+    step_count = len(tool_calls)
+    consumers: Dict[int, Set[int]] = {}
+    for step, deps in enumerate(dependencies, start=1):
+        for dep in deps:
+            if not 1 <= dep <= step_count:
+                raise ValueError(f"Step {step} refers to the result of step {dep}, which does not exist.")
+            consumers.setdefault(dep, set()).add(step)
+
+    units: List[List[int]] = []
+    unit_of: Dict[int, int] = {}
+    for step, ((tool_name, tool_args), deps) in enumerate(zip(tool_calls, dependencies), start=1):
+        if tool_name in FUSABLE_TOOLS and len(deps) == 1:
+            (dep,) = deps
+            unit = units[unit_of[dep]] if dep in unit_of else None
+            if (unit is not None and unit[-1] == dep
+                    and tool_calls[dep - 1][0] in FUSABLE_TOOLS
+                    and consumers[dep] == {step}
+                    and not consumers.get(step, set()) & set(unit)
+                    and tool_args.get("active_video_id") == f"{{{{result_of_step_{dep}}}}}"):
+                unit.append(step)
+                unit_of[step] = unit_of[dep]
+                continue
+        unit_of[step] = len(units)
+        units.append([step])
+
+    # Kahn's algorithm over the units.
+    unit_deps = [{unit_of[dep] for step in unit for dep in dependencies[step - 1]} - {idx} for idx, unit in enumerate(units)]
+    stages = []
+    done: Set[int] = set()
+    while len(done) < len(units):
+        ready = [idx for idx in range(len(units)) if idx not in done and unit_deps[idx] <= done]
+        if not ready:
+            stuck = [units[idx][0] for idx in range(len(units)) if idx not in done]
+            raise ValueError(f"Steps {stuck} refer to each other's results in a cycle.")
+        stages.append([units[idx] for idx in ready])
+        done.update(ready)
+    return stages
+
+
+def _run_unit(calls: List[Tuple[str, Dict[str, Any]]], media: MutableMapping[str, str], intermediate: bool = False) -> str:
+    """
+    Runs one unit of the plan, fused into one ffmpeg pass when it has several steps, and
+    returns its output path. Deterministic edits are memoized on their inputs' file versions.
+    `intermediate` units only feed later steps, so they are encoded for speed.
+    """
+    video_path = media.get(calls[0][1].get("active_video_id"))
+    if len(calls) == 1:
+        tool_name, tool_args = calls[0]
+        if tool_name == "trim_video":
+            # A lone trim can skip re-encoding when its cut points sit near keyframes.
+            calls = [(tool_name, {**tool_args, "stream_copy": True})]
+        produce = lambda: _invoke_tool(*calls[0], media)
+        operation = tool_name
+    else:
+        logger.info("Fusing %d steps into a single ffmpeg pass", len(calls))
+        video_path = video_tools.resolve_video_path(calls[0][1]["active_video_id"], media)
+        def produce():
+            with _EDIT_SEMAPHORE:
+                result_path = video_tools.apply_fused_edits(video_path, calls)
+            if not result_path.lower().startswith("error:"):
+                return result_path
+            logger.warning(f"Fused edit failed ({result_path}); running its steps one by one.")
+            return _run_chain(calls, media)
+        operation = "fused"
+
+    if intermediate:
+        encode = produce
+        def produce():
+            with video_tools.intermediate_encoding():
+                return encode()
+
+    sources = _source_paths(calls[0][1], media)
+    if calls[0][0] in MEMOIZABLE_TOOLS and sources:
+        params = [(tool_name, _memo_params(tool_args)) for tool_name, tool_args in calls]
+        if intermediate:
+            # A speed-tuned encode must not be handed back later as a final output.
+            params.append("intermediate")
+        result_path = video_tools.memoized_output(operation, sources, params, produce)
+    else:
+        result_path = produce()
+
+    if video_path and calls[0][0] in FUSABLE_TOOLS and not result_path.lower().startswith("error:"):
+        # The output's duration/fps/resolution follow from the input, so the next step can skip ffprobe.
+        video_tools.prime_probe_cache(video_path, result_path, calls)
+    return result_path
+
+
+def _run_single_action(instruction: str, media_bin: Dict[str, str], active_video_id: Optional[str]) -> Dict[str, Any]:
+    """
+    Runs a lone, self-contained instruction: one tool call, no placeholder
+    bookkeeping, step chaining or output selection.
+    """
+    media_ids = {os.path.basename(p): i for i, p in media_bin.items()}
+    try:
+        (tool_name, tool_args), = _plan_tool_calls([instruction], active_video_id, media_ids)
+        # The overlay only catches what extract_audio registers, which isn't needed afterwards.
+        result_path = _run_unit([(tool_name, tool_args)], ChainMap({}, media_bin))
+    except Exception as e:
+        logger.error(f"An error occurred during tool execution: {e}")
+        return {"error": f"Error during editing: {e}"}
+    return _edit_response([result_path])
+
+
 def unified_edit_executor(state: GraphState):
     """
     Executes a list of natural language editing instructions by dynamically
@@ -26,148 +584,145 @@ def unified_edit_executor(state: GraphState):
     active_video_id = state.get("active_video_id")
 
     if not nl_actions:
-        return {**state, "error": "No actions to execute."}
-
-    # Use the tools directly from the video_engine
-    tools = [
-        video_tools.trim_video,
-        video_tools.add_text_to_video,
-        video_tools.apply_filter_to_video,
-        video_tools.change_video_speed,
-        video_tools.concatenate_videos,
-        video_tools.extract_audio,
-        video_tools.add_audio_to_video,
-        video_tools.extract_and_add_audio
-    ]
-    tool_map = {t.name: t for t in tools}
-    
+        return {"error": "No actions to execute."}
+
+    if len(nl_actions) == 1 and not _STEP_REFERENCE_RE.search(nl_actions[0]):
+        # The common case: a single edit needs none of the multi-step machinery below.
+        return _run_single_action(nl_actions[0], media_bin, active_video_id)
+
     results = {}
-    temp_media_bin = dict(media_bin)
+    # Step results and extracted audio are written to the front map; the request's media bin is never copied or mutated.
+    temp_media_bin = ChainMap({}, media_bin)
     temp_media_ids = {}
     final_outputs = []
 
-    TOOL_CALLER_PROMPT_TEMPLATE = """You are a precise AI tool-calling assistant. Your ONLY job is to convert a natural language instruction into a single, valid JSON tool call based on the available tools.
+    def temp_id_for_step(step: int) -> Optional[str]:
+        """Registers the result of `step` in the temporary media bin and returns its ID."""
+        if step not in results:
+            return None
+        if step not in temp_media_ids:
+            temp_id = f"temp_result_{step}"
+            temp_media_ids[step] = temp_id
+            temp_media_bin[temp_id] = results[step]
+        return temp_media_ids[step]
 
-**Available Tools & Formats:**
-- `trim_video(active_video_id: str, start_time: float, end_time: float)`
-- `add_text_to_video(active_video_id: str, text: str, start_time: float, duration: float, position: str = "center", ...)`
-- `apply_filter_to_video(active_video_id: str, filter_description: str)`
-- `change_video_speed(active_video_id: str, speed_factor: float)`
-- `concatenate_videos(video_ids: List[str])`
-- `extract_audio(active_video_id: str)`
-- `add_audio_to_video(video_id: str, audio_id: str)`
-- `extract_and_add_audio(source_video_id: str, destination_video_id: str)`
 
-**CRITICAL RULES:**
-1.  **Output ONLY the JSON tool call.** Your entire response should be a single JSON object.
-2.  The "action" field in your JSON MUST match one of the available tool names exactly.
-3.  If the instruction refers to a result from a previous step (e.g., "the edited video"), you MUST use the placeholder `{{{{result_of_step_N}}}}` for the ID.
-4.  If the instruction mentions a filename (e.g., "video1.mp4"), find its ID from the Media Bin context and use the ID.
-5.  If no specific video is mentioned and it's the first step, use the `active_video_id` for the `active_video_id` parameter.
-
-**Context:**
-- **Instruction to parse:** "{instruction}"
-- **Active Video ID:** "{active_video_id}"
-- **Media Bin (filename: id):** {media_bin_context}
-- **Results of previous steps (for placeholders):** {results_context}
-
-Now, generate the single JSON tool call for the instruction.
-"""
-
-    model = ChatOpenAI(temperature=0, model="gpt-4-turbo-preview", model_kwargs={"response_format": {"type": "json_object"}})
     
-    media_bin_context = {Path(p).name: i for i, p in media_bin.items()}
-
-    for step_idx, instruction in enumerate(nl_actions):
-        logger.info(f"--- Executor: Step {step_idx + 1}/{len(nl_actions)} ---")
-        logger.info(f"Instruction: '{instruction}'")
-
+    media_ids = {os.path.basename(p): i for i, p in media_bin.items()}
+
+    def run_unit(calls: List[Tuple[str, Dict[str, Any]]], intermediate: bool = False) -> Tuple[str, Dict[str, str]]:
+        """Runs one unit of the plan. Returns its output path and any media IDs it registered (e.g. extracted audio)."""
+        # Units of a stage run concurrently, so each writes to its own overlay; the
+        # shared media bin is only updated between stages.
+        media = temp_media_bin.new_child()
+        return _run_unit(calls, media, intermediate), media.maps[0]
+
+    def record(completed: List[tuple]) -> bool:
+        """Stores finished steps for later placeholders. Returns False if a step failed."""
+        nonlocal final_outputs
+        for step, result_path in completed:
+            # Store result for future steps
+            results[step] = result_path # Always store the path
+            temp_media_bin[f"temp_result_{step}"] = result_path # Always map the temp ID to the path
+
+            # --- CRITICAL: Error checking ---
+            # If the tool returned an error string, stop execution immediately.
+            if isinstance(result_path, str) and result_path.lower().startswith("error:"):
+                logger.error(f"A tool failed at step {step}. Halting execution. Error: {result_path}")
+                # We'll let the final response formatting handle the error message.
+                final_outputs = [result_path]
+                return False
+
+            logger.debug("Step %d completed. Result: %s", step, result_path)
+
+            if step not in referenced_steps:
+                final_outputs.append(result_path)
+        return True
+
+    # Steps that need nothing from other steps and can't be fused are started while
+    # the rest of the plan is still streaming in.
+    started_early: Dict[int, Tuple[Tuple[str, Dict[str, Any]], Future]] = {}
+
+    def start_early(step: int, tool_name: str, tool_args: Dict[str, Any]) -> None:
+        """
+        Runs a self-contained, non-fusable step right away. Whether a later step consumes
+        its output isn't known yet, so it is encoded as a final output.
+        """
+        if tool_name not in FUSABLE_TOOLS and step not in started_early and not _referenced_steps(tool_args):
+            logger.debug("Starting step %d before planning finished", step)
+            started_early[step] = ((tool_name, tool_args), _STEP_POOL.submit(run_unit, [(tool_name, tool_args)]))
+
+    def discard_early(early_call: Tuple[str, Dict[str, Any]], future: Future) -> None:
+        """Cancels an early step whose result won't be used, or waits for it and deletes its output."""
+        if future.cancel():
+            return
         try:
-            prompt = TOOL_CALLER_PROMPT_TEMPLATE.format(
-                instruction=instruction,
-                results_context=json.dumps(list(results.keys())),
-                active_video_id=active_video_id,
-                media_bin_context=json.dumps(media_bin_context)
-            )
-            response = model.invoke([SystemMessage(content=prompt)])
-            
-            action_dict = json.loads(response.content)
-            
-            if "action" not in action_dict and len(action_dict) == 1:
-                tool_name = next(iter(action_dict.keys()))
-                tool_args = action_dict[tool_name]
-                action_dict = {"action": tool_name, **tool_args}
-
-            tool_name = action_dict.pop('action')
-            tool_args = action_dict
-
-            args_str = json.dumps(tool_args)
-            for prev_step, prev_result_path in results.items():
-                placeholder = f"{{{{result_of_step_{prev_step}}}}}"
-                if placeholder in args_str:
-                    if prev_step not in temp_media_ids:
-                        temp_id = f"temp_result_{prev_step}"
-                        temp_media_ids[prev_step] = temp_id
-                        temp_media_bin[temp_id] = prev_result_path
-                    
-                    temp_id_to_use = temp_media_ids[prev_step]
-                    args_str = args_str.replace(f'"{placeholder}"', f'"{temp_id_to_use}"')
-            
-            tool_args = json.loads(args_str)
-
-            # Add the media_bin to the arguments for the direct tool call
-            tool_args['media_bin'] = temp_media_bin
-
-            logger.info(f"Dispatching tool call: {tool_name}({tool_args})")
-
-            if tool_name in tool_map:
-                tool_function = tool_map[tool_name]
-                # This function invokes the tool and handles the result.
-                result_from_tool = tool_function.invoke(tool_args)
-
-                # --- Robust Result Handling ---
-                result_path = None
-                if tool_function.name == "extract_audio":
-                    try:
-                        audio_info = json.loads(result_from_tool)
-                        result_path = audio_info["output_path"]
-                        new_audio_id = audio_info["audio_id"]
-                        temp_media_bin[new_audio_id] = result_path # Manually update the media bin
-                        logger.info(f"Handled extract_audio output. Path: {result_path}, New ID: {new_audio_id}")
-                    except (json.JSONDecodeError, KeyError):
-                        logger.error(f"Could not parse result from extract_audio: {result_from_tool}")
-                        result_path = result_from_tool # Fallback
-                else:
-                    # For all other tools, the result is assumed to be a direct file path
-                    result_path = result_from_tool
-
-
-                # Store result for future steps
-                temp_id = f"temp_result_{step_idx}"
-                results[step_idx + 1] = result_path # Always store the path
-                temp_media_bin[temp_id] = result_path # Always map the temp ID to the path
-
-                # --- CRITICAL: Error checking ---
-                # If the tool returned an error string, stop execution immediately.
-                if isinstance(result_path, str) and result_path.lower().startswith("error:"):
-                    logger.error(f"A tool failed at step {step_idx}. Halting execution. Error: {result_path}")
-                    # We'll let the final response formatting handle the error message.
-                    final_outputs = [result_path]
-                    break # Exit the loop immediately
-
-                logger.info(f"Step {step_idx + 1} completed. Result: {result_path}")
-                
-                is_dependency = any(f"step {step_idx + 1}" in act for act in nl_actions[step_idx+1:])
-                if not is_dependency:
-                    final_outputs.append(result_path)
-
-            else:
-                raise ValueError(f"Unknown tool: {tool_name}")
-
+            result_path, _ = future.result()
         except Exception as e:
-            logger.error(f"An error occurred during tool execution: {e}")
-            # Optionally, you can add the error to the state to be surfaced to the user
-            return {**state, "error": f"Error during editing: {e}"}
+            logger.warning(f"Discarded early step failed: {e}")
+            return
+        # Memoized outputs stay: they are reused when the same edit is made again.
+        if early_call[0] not in MEMOIZABLE_TOOLS and not result_path.lower().startswith("error:"):
+            try:
+                os.remove(result_path)
+            except OSError:
+                pass
+
+    try:
+        # One request plans every step; placeholders tie the steps together.
+        tool_calls = _plan_tool_calls(nl_actions, active_video_id, media_ids, on_call=start_early)
+        dependencies = [_referenced_steps(tool_args) for _, tool_args in tool_calls]
+        stages = _schedule(tool_calls, dependencies)
+        # Steps whose results later steps use, as planned (not as the instructions happen to word it).
+        referenced_steps = set().union(*dependencies)
+    except Exception as e:
+        logger.error(f"An error occurred while planning tool calls: {e}")
+        for early_call, future in started_early.values():
+            discard_early(early_call, future)
+        return {"error": f"Error during editing: {e}"}
+
+    try:
+        for stage_idx, stage in enumerate(stages, start=1):
+            logger.debug("--- Executor: Stage %d/%d, steps %s ---", stage_idx, len(stages), stage)
+            jobs = []
+            for unit in stage:
+                if unit[0] in started_early:
+                    early_call, future = started_early[unit[0]]
+                    # Only reuse it if the final plan (e.g. from the fallback model) agrees.
+                    if early_call == tool_calls[unit[0] - 1]:
+                        jobs.append(future)
+                        continue
+                    discard_early(*started_early.pop(unit[0]))
+                calls = [tool_calls[step - 1] for step in unit]
+                # Only the first step of a unit takes outside inputs; the rest chain off it.
+                calls[0] = (calls[0][0], _substitute_placeholders(calls[0][1], temp_id_for_step))
+                # A unit's output is the last step's; if a later step uses it, it is only an intermediate.
+                jobs.append((calls, unit[-1] in referenced_steps))
+
+            # Units in a stage don't depend on each other, so they run concurrently.
+            if len(jobs) == 1 and not isinstance(jobs[0], Future):
+                stage_results = [run_unit(*jobs[0])]
+            else:
+                futures = [job if isinstance(job, Future) else _STEP_POOL.submit(run_unit, *job) for job in jobs]
+                stage_results = [future.result() for future in futures]
+            for unit in stage:
+                started_early.pop(unit[0], None)
+
+            completed = []
+            for unit, (result_path, registered) in zip(stage, stage_results):
+                temp_media_bin.update(registered)
+                completed += [(step, result_path) for step in unit]
+            if not record(sorted(completed)):
+                break
+
+    except Exception as e:
+        logger.error(f"An error occurred during tool execution: {e}")
+        # Optionally, you can add the error to the state to be surfaced to the user
+        return {"error": f"Error during editing: {e}"}
+    finally:
+        # Early steps the final plan dropped, or whose stage never ran because a step failed.
+        for early_call, future in started_early.values():
+            discard_early(early_call, future)
 
     # --- Definitive Final Output Logic v2 ---
     # (This logic will now correctly handle the error passed in final_outputs)
@@ -190,14 +745,8 @@ Now, generate the single JSON tool call for the instruction.
         # Otherwise, for parallel/batch operations, use the dependency graph to find all
         # outputs that are not used as inputs by subsequent steps.
         if results:
-            input_steps = set()
-            for instruction in nl_actions:
-                matches = re.findall(r"result of step (\d+)", instruction)
-                for match in matches:
-                    input_steps.add(int(match))
-
             for step_num, result_path in results.items():
-                if step_num not in input_steps:
+                if step_num not in referenced_steps:
                     final_outputs.append(result_path)
             
             # Failsafe: if for some reason the above yields nothing, take the last result.
@@ -209,34 +758,6 @@ Now, generate the single JSON tool call for the instruction.
         final_outputs.append(results[max(results.keys())])
     elif not final_outputs:
         # Handle case where no edits were made or failed
-        return {**state, "messages": [AIMessage(content="No final output was generated.")]}
+        return {"messages": [AIMessage(content="No final output was generated.")]}
 
-    # --- FINAL RESPONSE ---
-    # The `output_files` field will now be populated for the frontend to render.
-    final_output_urls = [f"/outputs/{Path(p).name}" for p in final_outputs]
-
-    if len(final_outputs) > 1:
-        final_message = f"Successfully created {len(final_outputs)} new videos. They have been added to your media bin."
-        return {
-            **state,
-            "output_files": final_outputs,
-            "messages": [AIMessage(
-                content=final_message,
-                additional_kwargs={"output_urls": final_output_urls}
-            )]
-        }
-    
-    # Single output case remains the same
-    final_media_path = final_outputs[0]
-    output_url = f"/outputs/{Path(final_media_path).name}" if final_media_path else None
-    
-    final_message = "Video editing complete! Your new video is ready."
-    
-    return {
-        **state,
-        "output_files": final_outputs,
-        "messages": [AIMessage(
-            content=final_message,
-            additional_kwargs={"output_url": output_url, "filename": Path(final_media_path).name if final_media_path else None}
-        )]
-    }
+    return _edit_response(final_outputs)
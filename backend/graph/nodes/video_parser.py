@@ -36,7 +36,7 @@ def video_parser(state: GraphState):
     video_path = state.get("video_path")
     
     if not video_path:
-        return {**state, "error": "No video path provided for analysis."}
+        return {"error": "No video path provided for analysis."}
         
     analysis_text = get_video_analysis(video_path)
     
@@ -45,6 +45,5 @@ def video_parser(state: GraphState):
     }
     
     return {
-        **state,
         "video_metadata": metadata
     }
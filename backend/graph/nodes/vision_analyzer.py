@@ -1,6 +1,35 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
 from backend.graph.state import GraphState
 from backend.ai_services.vision import analyze_video_content
 
+# Analyses started early by the chatbot (see `prefetch_video_analysis`), keyed by video path.
+# Prefetches the analyzer never consumes are dropped oldest-first beyond _MAX_PREFETCHED.
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="vision-prefetch")
+_MAX_PREFETCHED = 32
+_prefetched: "OrderedDict[str, Future]" = OrderedDict()
+_prefetch_lock = threading.Lock()
+
+
+def prefetch_video_analysis(state: GraphState) -> None:
+    """
+    Starts analysing the active video in the background so the work overlaps with
+    the rest of the chatbot's streamed reply. `vision_analyzer_node` waits on it.
+    """
+    video_path = state.get("media_bin", {}).get(state.get("active_video_id"))
+    if not video_path:
+        return
+
+    with _prefetch_lock:
+        if video_path not in _prefetched:
+            _prefetched[video_path] = _PREFETCH_POOL.submit(analyze_video_content, video_path)
+            while len(_prefetched) > _MAX_PREFETCHED:
+                _, stale = _prefetched.popitem(last=False)
+                stale.cancel()
+
+
 def vision_analyzer_node(state: GraphState):
     """
     Analyzes the video content using a vision model and updates the state.
@@ -17,20 +46,22 @@ def vision_analyzer_node(state: GraphState):
     if not video_path:
         print(f"❌ Error: No video path found for active_video_id '{active_video_id}'")
         print(f"Available videos in media_bin: {list(media_bin.keys())}")
-        return {**state, "error": f"Video path not found for ID '{active_video_id}'."}
+        return {"error": f"Video path not found for ID '{active_video_id}'."}
     
     print(f"Analyzing video: {video_path}")
 
     try:
-        # Call the vision analysis function
-        description = analyze_video_content(video_path)
+        # Call the vision analysis function, reusing a prefetched analysis if one was started
+        with _prefetch_lock:
+            prefetched = _prefetched.pop(video_path, None)
+        description = prefetched.result() if prefetched is not None else analyze_video_content(video_path)
         print(f"✅ Vision analysis complete. Description: {description[:100]}...")
         
         # Update the state with the new description
-        return {**state, "video_description": description}
+        return {"video_description": description}
 
     except Exception as e:
         print(f"❌ Error during vision analysis: {e}")
         import traceback
         traceback.print_exc()
-        return {**state, "error": f"Failed to analyze video content: {e}"}
+        return {"error": f"Failed to analyze video content: {e}"}
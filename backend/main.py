@@ -42,8 +42,11 @@ if str(PROJECT_ROOT) not in sys.path:
 
 import os
 import uuid
+from urllib.parse import urlparse
 import tempfile
-import json
+import logging
+import shutil
+import anyio
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -56,6 +59,10 @@ from backend.database import models
 from backend.database.database import engine
 from backend.api import endpoints
 
+# Logging is configured once here; library modules only create their own loggers.
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
 models.Base.metadata.create_all(bind=engine)
 
 
@@ -86,8 +93,9 @@ print(f"--- Using output directory for edited videos: {OUTPUT_DIR} ---")
 UPLOAD_DIR.mkdir(exist_ok=True, parents=True)
 OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
 
-# FFmpeg path
-FFMPEG_PATH = r'C:\\Program Files\\JianyingPro\\Apps\\5.7.0.11527\\ffmpeg.exe'
+# Uploads are copied to disk in chunks of this many bytes.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class EditCommandRequest(BaseModel):
     """Request model for video editing commands"""
@@ -98,6 +106,29 @@ class EditCommandRequest(BaseModel):
     video_description: str = ""
     chat_history: List[Dict[str, str]] = []
 
+def _save_upload(source, file_path: Path) -> None:
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(source, buffer, length=UPLOAD_CHUNK_SIZE)
+
+def _resolve_media_paths(media_bin: Dict[str, str]) -> Dict[str, str]:
+    """Maps each media ID's URL to the file it names in the uploads or outputs directory."""
+    reconstructed_media_bin = {}
+    for video_id, video_url in media_bin.items():
+        # Only the URL's path names the file; a query string or fragment must not end up in it.
+        filename = Path(urlparse(video_url).path).name
+        
+        # Check for the video in both the uploads and outputs directories
+        video_path_in_uploads = UPLOAD_DIR / filename
+        video_path_in_outputs = OUTPUT_DIR / filename
+        
+        if video_path_in_uploads.exists():
+            reconstructed_media_bin[video_id] = str(video_path_in_uploads)
+        elif video_path_in_outputs.exists():
+            reconstructed_media_bin[video_id] = str(video_path_in_outputs)
+        else:
+            raise HTTPException(status_code=404, detail=f"Video file for ID '{video_id}' not found: {filename}")
+    return reconstructed_media_bin
+
 # Define routes
 @app.get("/")
 def read_root():
@@ -112,12 +143,12 @@ async def upload_media(file: UploadFile = File(...)):
         safe_filename = f"{file_id}{file_extension}"
         file_path = UPLOAD_DIR / safe_filename
         
-        # Save file
-        content = await file.read()
-        with open(file_path, "wb") as buffer:
-            buffer.write(content)
+        # Save file, streaming it in chunks so large uploads never sit in memory whole. The
+        # whole copy runs in one worker thread instead of hopping threads for every chunk.
+        await anyio.to_thread.run_sync(_save_upload, file.file, file_path)
+        size = file_path.stat().st_size
         
-        print(f"File uploaded: {safe_filename} ({len(content)} bytes)")
+        print(f"File uploaded: {safe_filename} ({size} bytes)")
         
         # Generate analysis for video files only
         description = ""
@@ -134,7 +165,7 @@ async def upload_media(file: UploadFile = File(...)):
             "file_id": file_id,
             "filename": file.filename,
             "url": f"/uploads/{safe_filename}",
-            "size": len(content),
+            "size": size,
             "file_path": str(file_path),
             "description": description
         }
@@ -177,7 +208,7 @@ Recommended effects: Transitions, color grading"""
             "message": "Video analysis complete"
         }
         
-        print(f"Response: {json.dumps(response, indent=2)}")
+        logger.debug("Response: %s", response)
         return response
         
     except Exception as e:
@@ -196,20 +227,8 @@ async def edit_video(request: EditCommandRequest):
         print(f"Command: {request.command}")
         
         # --- NEW: Reconstruct media_bin with server-side file paths ---
-        reconstructed_media_bin = {}
-        for video_id, video_url in request.media_bin.items():
-            filename = Path(video_url).name
-            
-            # Check for the video in both the uploads and outputs directories
-            video_path_in_uploads = UPLOAD_DIR / filename
-            video_path_in_outputs = OUTPUT_DIR / filename
-            
-            if video_path_in_uploads.exists():
-                reconstructed_media_bin[video_id] = str(video_path_in_uploads)
-            elif video_path_in_outputs.exists():
-                reconstructed_media_bin[video_id] = str(video_path_in_outputs)
-            else:
-                raise HTTPException(status_code=404, detail=f"Video file for ID '{video_id}' not found: {filename}")
+        # All the lookups happen in one worker thread rather than one thread hop per stat call.
+        reconstructed_media_bin = await anyio.to_thread.run_sync(_resolve_media_paths, request.media_bin)
         
         print(f"Reconstructed Media Bin for Backend: {reconstructed_media_bin}")
 
@@ -232,7 +251,9 @@ async def edit_video(request: EditCommandRequest):
             "video_description": request.video_description,
         }
         
-        result = graph_app.invoke(initial_state)
+        # The graph blocks (model calls, ffmpeg) for seconds at a time, so it runs in a worker
+        # thread to keep the event loop free for other requests.
+        result = await anyio.to_thread.run_sync(graph_app.invoke, initial_state)
         
         # The final result is contained in the last message added by the graph.
         final_message = result.get("messages", [])[-1]
@@ -262,7 +283,7 @@ async def edit_video(request: EditCommandRequest):
             "request_id": str(uuid.uuid4())
         }
         
-        print(f"Response: {json.dumps(response, indent=2)}")
+        logger.debug("Response: %s", response)
         return response
         
     except Exception as e:
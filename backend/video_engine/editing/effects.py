@@ -1,6 +1,11 @@
+import functools
+import os
+from typing import Optional, Tuple
+
 import cv2
 import numpy as np
-from moviepy.editor import VideoClip, TextClip, CompositeVideoClip
+from moviepy.video.VideoClip import VideoClip, ImageClip
+from PIL import Image, ImageDraw, ImageFont
 
 # --- OpenCV Filter Implementations ---
 # Each function takes a frame (NumPy array) and returns a modified frame.
@@ -8,58 +13,66 @@ from moviepy.editor import VideoClip, TextClip, CompositeVideoClip
 def _apply_blackwhite(frame):
     """Converts a frame to black and white."""
     gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR) # Convert back to 3 channels for moviepy
+    # Back to 3 channels for moviepy: copy the plane into each channel rather than
+    # running it through cvtColor's generic GRAY2BGR converter.
+    out = np.empty(frame.shape, np.uint8)
+    out[..., 0] = out[..., 1] = out[..., 2] = gray
+    return out
+
+_SEPIA_KERNEL = np.array([[0.272, 0.534, 0.131],
+                          [0.349, 0.686, 0.168],
+                          [0.393, 0.769, 0.189]])
 
 def _apply_sepia(frame):
     """Applies a sepia tone effect."""
-    kernel = np.array([[0.272, 0.534, 0.131],
-                       [0.349, 0.686, 0.168],
-                       [0.393, 0.769, 0.189]])
-    sepia_frame = cv2.transform(frame, kernel)
-    sepia_frame = np.clip(sepia_frame, 0, 255) # Ensure values are within display range
-    return sepia_frame.astype('uint8')
+    # cv2.transform keeps the uint8 depth and saturates to 0-255 itself, so no clip/astype pass is needed.
+    return cv2.transform(frame, _SEPIA_KERNEL)
 
-def _adjust_lum_contrast(frame, lum=0, contrast=0):
-    """Adjusts the luminosity and contrast of a frame."""
-    # Formula: new_image = alpha * original_image + beta
-    # alpha (contrast): >1.0 increases, <1.0 decreases
-    # beta (brightness): positive increases, negative decreases
+@functools.lru_cache(maxsize=64)
+def _lum_contrast_lut(lum, contrast):
+    """
+    The 256-entry lookup table for a luminosity/contrast adjustment.
+    Formula: new_image = alpha * original_image + beta
+    alpha (contrast): >1.0 increases, <1.0 decreases
+    beta (brightness): positive increases, negative decreases
+    """
     alpha = 1.0 + (contrast / 127.0)
     beta = lum
-    adjusted = cv2.convertScaleAbs(frame, alpha=alpha, beta=beta)
-    return adjusted
+    # Same rounding and saturation as cv2.convertScaleAbs: saturate(round(|alpha * x + beta|)).
+    return np.clip(np.rint(np.abs(alpha * np.arange(256) + beta)), 0, 255).astype(np.uint8)
+
+def _adjust_lum_contrast(frame, lum=0, contrast=0):
+    """Adjusts the luminosity and contrast of a frame."""
+    # A pointwise map on uint8, so one table lookup per byte does it.
+    return cv2.LUT(frame, _lum_contrast_lut(lum, contrast))
 
 def _apply_blur(frame, ksize=(5, 5)):
     """Applies a standard box blur."""
-    # ksize must be a tuple of odd numbers
-    ksize = (int(ksize[0]) // 2 * 2 + 1, int(ksize[1]) // 2 * 2 + 1)
     return cv2.blur(frame, ksize)
 
 def _apply_gaussian_blur(frame, ksize=(5, 5), sigmaX=0):
     """Applies a Gaussian blur."""
-    ksize = (int(ksize[0]) // 2 * 2 + 1, int(ksize[1]) // 2 * 2 + 1)
     return cv2.GaussianBlur(frame, ksize, sigmaX)
 
 def _apply_median_blur(frame, ksize=5):
     """Applies a median blur, effective for removing noise."""
-    # ksize must be an odd integer
-    ksize = int(ksize) // 2 * 2 + 1
     return cv2.medianBlur(frame, ksize)
 
 def _apply_color_tint(frame, color: str):
     """Applies a red, green, or blue tint to the frame."""
-    b, g, r = cv2.split(frame)
-    zeros = np.zeros_like(b)
-    
+    if color not in ('red', 'green', 'blue'):
+        return frame # Return original if color is not recognized
+
+    # One copy with the other channels zeroed in place, instead of split + zeros + merge.
+    tinted = frame.copy()
     if color == 'red':
-        # Boost red, suppress others slightly
-        return cv2.merge([zeros, zeros, r])
+        tinted[..., 0:2] = 0
     elif color == 'green':
-        return cv2.merge([zeros, g, zeros])
-    elif color == 'blue':
-        return cv2.merge([b, zeros, zeros])
+        tinted[..., 0] = 0
+        tinted[..., 2] = 0
     else:
-        return frame # Return original if color is not recognized
+        tinted[..., 1:3] = 0
+    return tinted
 
 
 # --- Filter Dispatcher ---
@@ -74,6 +87,83 @@ CV2_FILTERS = {
     "color_tint": _apply_color_tint,
 }
 
+# Filters made only of OpenCV calls, which the T-API can run on an OpenCL device when the
+# frame is passed as a cv2.UMat. OpenCV's own OPENCV_OPENCL_DEVICE=disabled turns this off.
+OPENCL_FILTERS = {"sepia", "lum_contrast", "blur", "gaussian_blur", "median_blur"}
+USE_OPENCL = cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
+# Below about a megapixel the upload/download costs more than the filter saves.
+OPENCL_MIN_PIXELS = 1 << 20
+
+def _on_opencl(filter_func):
+    """Wraps a filter so each frame is processed as a UMat and downloaded once at the end."""
+    def apply(frame):
+        return filter_func(cv2.UMat(frame)).get()
+    return apply
+
+# --- FFmpeg Equivalents ---
+# The same filters as ffmpeg filter expressions, so a filter can be applied in a single
+# ffmpeg pass instead of decoding, calling back into Python per frame and re-encoding.
+# MoviePy frames are RGB while the OpenCV filters read them as BGR; the channel weights
+# below reproduce the OpenCV filters' output exactly.
+
+def _ffmpeg_blur(duration, ksize=(5, 5)):
+    radius_x, radius_y = int(ksize[0]) // 2, int(ksize[1]) // 2
+    if not radius_x and not radius_y:
+        return "null"  # A 1x1 box leaves the frame unchanged.
+    return f"avgblur=sizeX={max(radius_x, 1)}:sizeY={max(radius_y, 1)}"
+
+def _ffmpeg_median_blur(duration, ksize=5):
+    radius = int(ksize) // 2
+    return f"median=radius={radius}" if radius else "null"
+
+def _ffmpeg_gaussian_blur(duration, ksize=(5, 5), sigmaX=0):
+    kx, ky = (int(ksize[0]) // 2 * 2 + 1, int(ksize[1]) // 2 * 2 + 1)
+    # OpenCV derives sigma from the kernel size when sigmaX is 0.
+    sigma_x = sigmaX or 0.3 * ((kx - 1) * 0.5 - 1) + 0.8
+    sigma_y = sigmaX or 0.3 * ((ky - 1) * 0.5 - 1) + 0.8
+    return f"gblur=sigma={sigma_x}:sigmaV={sigma_y}"
+
+def _ffmpeg_lum_contrast(duration, lum=0, contrast=0):
+    alpha = 1.0 + (contrast / 127.0)
+    # convertScaleAbs: saturate(|alpha * x + beta|)
+    expr = f"clip(abs(val*{alpha}+{lum}),0,255)"
+    return f"lutrgb=r='{expr}':g='{expr}':b='{expr}'"
+
+# _apply_color_tint keeps the channel it calls r/g/b of what it reads as a BGR frame.
+_TINT_MIXERS = {
+    "red": "rr=0:gg=0:bb=1",
+    "green": "rr=0:gg=1:bb=0",
+    "blue": "rr=1:gg=0:bb=0",
+}
+
+FFMPEG_FILTERS = {
+    "blackwhite": lambda duration: "colorchannelmixer=.114:.587:.299:0:.114:.587:.299:0:.114:.587:.299",
+    "sepia": lambda duration: "colorchannelmixer=.272:.534:.131:0:.349:.686:.168:0:.393:.769:.189",
+    "lum_contrast": _ffmpeg_lum_contrast,
+    "blur": _ffmpeg_blur,
+    "gaussian_blur": _ffmpeg_gaussian_blur,
+    "median_blur": _ffmpeg_median_blur,
+    "color_tint": lambda duration, color: f"colorchannelmixer={_TINT_MIXERS[color]}" if color in _TINT_MIXERS else "null",
+    "fadein": lambda duration, duration_=3.0: f"fade=t=in:st=0:d={duration_}",
+    "fadeout": lambda duration, duration_=3.0: f"fade=t=out:st={max(duration - duration_, 0)}:d={duration_}",
+}
+
+def ffmpeg_effect_filter(filter_name: str, video_duration: float, **kwargs) -> Optional[str]:
+    """
+    Returns the ffmpeg video filter equivalent to `apply_effects(clip, filter_name, **kwargs)`,
+    or None if the filter (or one of its arguments) has no ffmpeg equivalent.
+    """
+    if filter_name not in FFMPEG_FILTERS:
+        return None
+    if filter_name in ("fadein", "fadeout"):
+        # The fade's own duration would clash with the video duration argument.
+        kwargs = {"duration_": kwargs.get("duration", 3.0)}
+    try:
+        return FFMPEG_FILTERS[filter_name](video_duration, **kwargs)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
 def apply_effects(clip: VideoClip, filter_name: str, **kwargs) -> VideoClip:
     """
     Applies a video effect using a stable backend, dispatching to either
@@ -93,13 +183,59 @@ def apply_effects(clip: VideoClip, filter_name: str, **kwargs) -> VideoClip:
 
     filter_func = CV2_FILTERS[filter_name]
 
-    # Use a lambda to pass keyword arguments to the filter function
-    return clip.fl_image(lambda frame: filter_func(frame, **kwargs))
+    # Normalize arguments once here rather than on every frame.
+    # ksize must be odd: a tuple of odd numbers for box/Gaussian, an odd integer for median.
+    if filter_name in ("blur", "gaussian_blur") and "ksize" in kwargs:
+        ksize = kwargs["ksize"]
+        kwargs["ksize"] = (int(ksize[0]) // 2 * 2 + 1, int(ksize[1]) // 2 * 2 + 1)
+    if filter_name == "median_blur" and "ksize" in kwargs:
+        kwargs["ksize"] = int(kwargs["ksize"]) // 2 * 2 + 1
+
+    frame_func = functools.partial(filter_func, **kwargs)
+    if USE_OPENCL and filter_name in OPENCL_FILTERS and clip.w * clip.h >= OPENCL_MIN_PIXELS:
+        frame_func = _on_opencl(frame_func)
+    return clip.fl_image(frame_func)
 
 
 # --- Other Effects (Text Overlays) ---
 # These can remain as they are, since they are stable.
 
+# Any TrueType font Pillow can find by file name or path.
+TEXT_FONT = os.getenv("TEXT_FONT", "DejaVuSans.ttf")
+
+@functools.lru_cache(maxsize=16)
+def _load_font(fontsize: int) -> ImageFont.FreeTypeFont:
+    """Loads the overlay font once per size."""
+    try:
+        return ImageFont.truetype(TEXT_FONT, fontsize)
+    except OSError:
+        return ImageFont.load_default(size=fontsize)
+
+@functools.lru_cache(maxsize=32)
+def render_text(text: str, fontsize: int, color: str) -> ImageClip:
+    """
+    Rasterizes a text overlay in-process with Pillow (no ImageMagick subprocess), cropped to
+    the text. Renders are cached, so repeated titles and labels are drawn once;
+    positioning/timing a cached clip returns a copy, leaving it intact.
+    """
+    font = _load_font(fontsize)
+    left, top, right, bottom = ImageDraw.Draw(Image.new("RGBA", (1, 1))).multiline_textbbox((0, 0), text, font=font)
+    image = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+    ImageDraw.Draw(image).multiline_text((-left, -top), text, font=font, fill=color, align="center")
+    rgba = np.asarray(image)
+    mask = ImageClip(rgba[..., 3] / 255.0, ismask=True)
+    return ImageClip(rgba[..., :3]).set_mask(mask)
+
+def _caption_origin(position, frame_size, text_size) -> Tuple[int, int]:
+    """Resolves a MoviePy-style position (names or pixels) to the caption's top-left corner."""
+    (frame_w, frame_h), (text_w, text_h) = frame_size, text_size
+    x, y = position
+    if isinstance(x, str):
+        x = {"left": 0, "center": (frame_w - text_w) // 2, "right": frame_w - text_w}[x]
+    if isinstance(y, str):
+        y = {"top": 0, "center": (frame_h - text_h) // 2, "bottom": frame_h - text_h}[y]
+    return int(x), int(y)
+
 def add_caption(
     clip: VideoClip,
     text: str,
@@ -108,14 +244,35 @@ def add_caption(
     fontsize: int = 24,
     color: str = "white",
     position: tuple = ("center", "bottom"),
-) -> CompositeVideoClip:
+) -> VideoClip:
     """
     Adds a caption to a video clip.
+    The text is rasterized once and alpha-blended into just its bounding box while it is on
+    screen, instead of compositing a full-frame layer on every frame.
     """
-    caption_clip = (
-        TextClip(text, fontsize=fontsize, color=color)
-        .set_position(position)
-        .set_start(start_time)
-        .set_duration(duration)
-    )
-    return CompositeVideoClip([clip, caption_clip])
+    text_clip = render_text(text, fontsize, color)
+    fg = text_clip.get_frame(0).astype(np.float32)
+    alpha = text_clip.mask.get_frame(0)[..., None].astype(np.float32)
+    x0, y0 = _caption_origin(position, clip.size, text_clip.size)
+
+    # Clip the caption box to the frame so off-edge positions don't break the slicing.
+    frame_w, frame_h = clip.size
+    left, top = max(x0, 0), max(y0, 0)
+    right, bottom = min(x0 + fg.shape[1], frame_w), min(y0 + fg.shape[0], frame_h)
+    if right <= left or bottom <= top:
+        return clip
+    fg = fg[top - y0:bottom - y0, left - x0:right - x0]
+    alpha = alpha[top - y0:bottom - y0, left - x0:right - x0]
+    end_time = start_time + duration
+
+    def blit(get_frame, t):
+        frame = get_frame(t)
+        if not start_time <= t < end_time:
+            return frame
+        # Readers hand back their cached last frame, so blend into a copy, never in place.
+        frame = frame.copy()
+        roi = frame[top:bottom, left:right]
+        roi[:] = (roi * (1 - alpha) + fg * alpha).astype(np.uint8)
+        return frame
+
+    return clip.fl(blit, apply_to=[])
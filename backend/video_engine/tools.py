@@ -1,23 +1,25 @@
+import bisect
+import contextlib
+import contextvars
+import functools
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.tools import tool
-from moviepy.editor import (
-    VideoFileClip,
-    AudioFileClip,
-    TextClip,
-    CompositeVideoClip,
-    concatenate_videoclips,
-    ColorClip,
-)
-import moviepy.video.fx.all as vfx
-from typing import Optional, Dict, List
+from typing import Callable, Optional, Dict, List, Tuple
 from pathlib import Path
+import os
+import re
+import subprocess
+import tempfile
 import uuid
 import json
+import orjson
 from backend.ai_services.filter_mapper import map_description_to_filter
-from backend.video_engine.editing.effects import apply_effects # <-- Import the robust function
+from backend.video_engine.editing.effects import add_caption, apply_effects, ffmpeg_effect_filter # <-- Import the robust function
 
-# Configure logging for this module
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Define the output directory relative to this file's location
@@ -25,6 +27,68 @@ logger = logging.getLogger(__name__)
 OUTPUT_DIR = Path(__file__).parent.parent.parent / "outputs"
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# ffmpeg/ffprobe are expected on the PATH (see README prerequisites).
+FFMPEG_BINARY = "ffmpeg"
+FFPROBE_BINARY = "ffprobe"
+_MAX_DERIVED_PROBES = 128
+
+# Total size of memoized edit outputs kept in OUTPUT_DIR before the oldest are evicted.
+MEMO_MAX_BYTES = int(os.environ.get("MEMO_MAX_BYTES", 5 * 1024 ** 3))
+# Memoized outputs end in a 16-hex-digit digest; other outputs use an 8-digit random ID.
+_MEMO_NAME_RE = re.compile(r"_[0-9a-f]{16}\.mp4$")
+# Memoized outputs returned by this process, which eviction leaves alone.
+_memo_handed_out = set()
+_memo_lock = threading.Lock()
+
+# How far (in seconds) a trim point may be moved to land on a keyframe so the trim can be stream-copied.
+KEYFRAME_SNAP_TOLERANCE = 0.5
+
+# Hardware H.264 encoders, in order of preference; libx264 (software) is the fallback.
+# VIDEO_ENCODER, if set, picks the encoder explicitly.
+HARDWARE_ENCODERS = ("h264_nvenc", "h264_videotoolbox", "h264_qsv")
+# Rate control per encoder; the hardware H.264 ones aim at roughly libx264's default quality (CRF 23).
+ENCODER_PARAMS = {
+    # libx264's default preset (medium) spends most of its time on compression gains an
+    # interactive editor doesn't need; veryfast roughly halves encode time at the same CRF.
+    "libx264": ["-preset", "veryfast", "-crf", "23"],
+    # NVENC's VBR treats -cq as a cap under its default bit rate unless -b:v 0 lifts the target.
+    "h264_nvenc": ["-preset", "p4", "-rc", "vbr", "-cq", "23", "-b:v", "0"],
+    "h264_qsv": ["-global_quality", "23"],
+    "h264_videotoolbox": ["-q:v", "65"],
+    # Opt-in with VIDEO_ENCODER=libsvtav1 when consumers accept AV1: the fastest preset,
+    # tuned for encode speed and cheap decoding.
+    "libsvtav1": ["-preset", "12", "-crf", "35", "-svtav1-params", "tune=0:fast-decode=1"],
+}
+# Faster settings at the same quality target for outputs that only feed another edit, which
+# re-encodes them anyway. Encoders not listed keep their ENCODER_PARAMS.
+INTERMEDIATE_ENCODER_PARAMS = {
+    "libx264": ["-preset", "ultrafast", "-crf", "23"],
+    "h264_nvenc": ["-preset", "p1", "-rc", "vbr", "-cq", "23", "-b:v", "0"],
+}
+_intermediate_encode = contextvars.ContextVar("intermediate_encode", default=False)
+# Output options for every re-encoded MP4: yuv420p plays in every browser, and +faststart
+# puts the index first so previews can start before the download finishes.
+OUTPUT_PARAMS = ["-pix_fmt", "yuv420p", "-movflags", "+faststart"]
+
+# Permits for the encodes running at once across concurrent requests. The executor holds one
+# for every tool call; a tool that runs several encodes in parallel takes spare permits for the
+# extra ones instead of oversubscribing the machine.
+EDIT_CONCURRENCY = int(os.environ.get("VIDEO_EDIT_CONCURRENCY", (os.cpu_count() or 2) // 2 or 1))
+EDIT_SEMAPHORE = threading.BoundedSemaphore(EDIT_CONCURRENCY)
+
+# How many concat inputs are normalized at once. Each is its own ffmpeg process, so threads
+# suffice; the cap keeps encoders (and hardware encoder sessions) from oversubscribing.
+CONCAT_NORMALIZE_WORKERS = int(os.environ.get("CONCAT_NORMALIZE_WORKERS", (os.cpu_count() or 2) // 2 or 1))
+
+# Where add_text overlays are placed, as drawtext x/y expressions.
+TEXT_POSITIONS = {
+    "center": ("(w-text_w)/2", "(h-text_h)/2"),
+    "top": ("(w-text_w)/2", "h*0.05"),
+    "bottom": ("(w-text_w)/2", "h*0.95-text_h"),
+}
+# Colors accepted for text overlays: a color name or hex RGB(A), optionally with an @alpha.
+DRAWTEXT_COLOR_RE = re.compile(r"(?:[A-Za-z]+|(?:#|0x)[0-9A-Fa-f]{6}(?:[0-9A-Fa-f]{2})?)(?:@(?:0|1|0?\.\d+))?")
+
 
 def get_output_path(input_path: str, suffix: str, extension: str = "mp4") -> str:
     """Creates a unique output path in the designated OUTPUT_DIR."""
@@ -40,27 +104,498 @@ def resolve_video_path(active_video_id: str, media_bin: Dict[str, str]) -> str:
         raise ValueError(f"Video ID '{active_video_id}' not found in the media bin.")
     return media_bin[active_video_id]
 
+
+@functools.lru_cache(maxsize=128)
+def _probe(video_path: str, mtime_ns: int, size: int) -> dict:
+    """Runs ffprobe. The file's mtime and size are part of the cache key so rewritten files are re-probed."""
+    result = subprocess.run(
+        [FFPROBE_BINARY, "-v", "error", "-show_format", "-show_streams", "-show_data_hash", "sha256",
+         "-of", "json", video_path],
+        check=True, capture_output=True, text=True,
+    )
+    return json.loads(result.stdout)
+
+
+# Probe results derived from an edit's input instead of running ffprobe on its output.
+_derived_probes: "OrderedDict[Tuple[str, int, int], dict]" = OrderedDict()
+_derived_probes_lock = threading.Lock()
+
+
+def _probe_key(video_path: str) -> Tuple[str, int, int]:
+    stat = os.stat(video_path)
+    return video_path, stat.st_mtime_ns, stat.st_size
+
+
+def probe_video(video_path: str) -> dict:
+    """
+    Returns ffprobe's format and stream information for a media file.
+    Results are cached and shared between callers, so they must not be mutated.
+    """
+    key = _probe_key(video_path)
+    with _derived_probes_lock:
+        derived = _derived_probes.get(key)
+    if derived is not None:
+        return derived
+    return _probe(*key)
+
+
+@functools.lru_cache(maxsize=32)
+def _keyframes(video_path: str, mtime_ns: int, size: int) -> Tuple[float, ...]:
+    """Returns the timestamps of the video stream's keyframes, in seconds."""
+    result = subprocess.run(
+        [FFPROBE_BINARY, "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+         "-show_entries", "frame=pts_time", "-of", "csv=p=0", video_path],
+        check=True, capture_output=True, text=True,
+    )
+    return tuple(sorted(float(line) for line in result.stdout.split() if line and line != "N/A"))
+
+
+def _nearest_keyframe(keyframes: Tuple[float, ...], time: float) -> Optional[float]:
+    """The keyframe closest to `time`, if it is within KEYFRAME_SNAP_TOLERANCE."""
+    index = bisect.bisect_left(keyframes, time)
+    candidates = keyframes[max(index - 1, 0):index + 1]
+    if not candidates:
+        return None
+    nearest = min(candidates, key=lambda keyframe: abs(keyframe - time))
+    return nearest if abs(nearest - time) <= KEYFRAME_SNAP_TOLERANCE else None
+
+
+@functools.lru_cache(maxsize=1)
+def _moviepy():
+    """
+    Imports moviepy.editor on first use. Only the fallback paths need MoviePy, and the editor
+    module loads every clip class and effect (patching effects such as speedx onto the clips).
+    """
+    import moviepy.editor
+    return moviepy.editor
+
+
+@functools.lru_cache(maxsize=1)
+def video_encoder() -> str:
+    """
+    The video encoder used for re-encoded outputs. ffmpeg builds often list hardware
+    encoders the machine can't drive, so each candidate is tried on a tiny test clip with
+    every set of options it would be run with.
+    """
+    if os.environ.get("VIDEO_ENCODER"):
+        return os.environ["VIDEO_ENCODER"]
+    for encoder in HARDWARE_ENCODERS:
+        final_params = tuple(ENCODER_PARAMS.get(encoder, []))
+        param_sets = dict.fromkeys([final_params, tuple(INTERMEDIATE_ENCODER_PARAMS.get(encoder, final_params))])
+        try:
+            results = [
+                subprocess.run(
+                    [FFMPEG_BINARY, "-hide_banner", "-f", "lavfi", "-i", "color=size=256x256:duration=0.1",
+                     "-c:v", encoder, *params, "-pix_fmt", "yuv420p", "-f", "null", "-"],
+                    capture_output=True,
+                )
+                for params in param_sets
+            ]
+        except OSError:
+            break
+        if all(result.returncode == 0 for result in results):
+            logger.info(f"Using hardware encoder {encoder}")
+            return encoder
+    return "libx264"
+
+
+def encoder_params() -> List[str]:
+    """Extra ffmpeg output options for the encoder returned by `video_encoder`, plus OUTPUT_PARAMS."""
+    encoder = video_encoder()
+    if _intermediate_encode.get() and encoder in INTERMEDIATE_ENCODER_PARAMS:
+        return INTERMEDIATE_ENCODER_PARAMS[encoder] + OUTPUT_PARAMS
+    return ENCODER_PARAMS.get(encoder, []) + OUTPUT_PARAMS
+
+
+def _write_clip(clip, output_path: str, **kwargs) -> None:
+    """
+    Writes a MoviePy clip with the selected encoder and the shared output settings from
+    `encoder_params`, on all cores and with AAC audio (MoviePy would otherwise put MP3 in the MP4).
+    """
+    params = encoder_params()
+    options = dict(codec=video_encoder(), audio_codec="aac", threads=os.cpu_count(), logger="bar")
+    if "-preset" in params:
+        # MoviePy always passes -preset itself (medium by default), so the encoder's preset
+        # goes through that option rather than a second, conflicting -preset.
+        index = params.index("-preset")
+        options["preset"] = params[index + 1]
+        params = params[:index] + params[index + 2:]
+    options["ffmpeg_params"] = params
+    options.update(kwargs)
+    clip.write_videofile(output_path, **options)
+
+
+@contextlib.contextmanager
+def intermediate_encoding():
+    """Within this block, encodes favour speed: the output is an intermediate another edit consumes."""
+    token = _intermediate_encode.set(True)
+    try:
+        yield
+    finally:
+        _intermediate_encode.reset(token)
+
+
+def find_stream_copy_cut(video_path: str, start_time: float, end_time: Optional[float]) -> Optional[Tuple[float, Optional[float]]]:
+    """
+    Snaps trim points to nearby keyframes. Returns the (start, end) to cut at without
+    re-encoding (end is None for "until the end"), or None if a point is too far from a keyframe.
+    """
+    keyframes = _keyframes(*_probe_key(video_path))
+    start = _nearest_keyframe(keyframes, start_time)
+    if start is None:
+        return None
+    if end_time is None:
+        return start, None
+    end = _nearest_keyframe(keyframes, end_time)
+    if end is None or end <= start:
+        return None
+    return start, end
+
+
+def _stream_copy_trim(video_path: str, start: float, end: Optional[float], output_path: str) -> None:
+    """Cuts a segment between keyframes by copying the packets instead of re-encoding."""
+    command = [FFMPEG_BINARY, "-y", "-ss", str(start)]
+    if end is not None:
+        command += ["-to", str(end)]
+    command += ["-i", video_path, "-c", "copy", "-avoid_negative_ts", "make_zero", "-movflags", "+faststart", output_path]
+    subprocess.run(command, check=True, capture_output=True)
+
+
+def _stream_signature(video_path: str) -> Tuple:
+    """
+    What must match between inputs for their packets to be joined without re-encoding. This always
+    probes the file itself: derived probe entries lack the codec details compared here.
+    """
+    info = _probe(*_probe_key(video_path))
+    return tuple(
+        (stream.get("codec_type"), stream.get("codec_name"), stream.get("profile"), stream.get("level"),
+         stream.get("codec_tag"), stream.get("extradata_hash"), stream.get("width"), stream.get("height"),
+         stream.get("pix_fmt"), stream.get("r_frame_rate"), stream.get("time_base"), stream.get("sample_rate"),
+         stream.get("channels"))
+        for stream in info.get("streams", [])
+        if stream.get("codec_type") in ("video", "audio")
+    )
+
+
+def _stream_copy_concat(video_paths: List[str], output_path: str) -> None:
+    """Joins videos with identical stream parameters using ffmpeg's concat demuxer, without re-encoding."""
+    fd, list_path = tempfile.mkstemp(suffix=".txt")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as list_file:
+            for path in video_paths:
+                escaped = str(Path(path).resolve()).replace("'", "'\\''")
+                list_file.write(f"file '{escaped}'\n")
+        subprocess.run(
+            [FFMPEG_BINARY, "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy",
+             "-movflags", "+faststart", output_path],
+            check=True, capture_output=True,
+        )
+    finally:
+        os.remove(list_path)
+
+
+def _normalize_for_concat(video_path: str, info: dict, target_size: Tuple[int, int], fps: str, with_audio: bool, output_path: str) -> None:
+    """
+    Re-encodes one concat input to the shared raster, frame rate and audio format, padding it
+    centered on black, so the normalized segments can be joined by `_stream_copy_concat`.
+    """
+    width, height = target_size
+    command = [FFMPEG_BINARY, "-y", "-i", video_path]
+    if with_audio and not has_audio_stream(info):
+        # A silent track keeps every segment's streams identical.
+        command += ["-f", "lavfi", "-i", "anullsrc=r=48000:cl=stereo", "-map", "0:v:0", "-map", "1:a:0", "-shortest"]
+    else:
+        command += ["-map", "0:v:0"] + (["-map", "0:a:0"] if with_audio else [])
+    command += ["-vf", f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=black,fps={fps},setsar=1",
+                "-c:v", video_encoder(), *encoder_params(), "-video_track_timescale", "90000"]
+    command += ["-c:a", "aac", "-ar", "48000", "-ac", "2"] if with_audio else ["-an"]
+    subprocess.run(command + [output_path], check=True, capture_output=True)
+
+
+def _first_audio_stream(info: dict) -> Optional[dict]:
+    """The first audio stream in probed media information, if any."""
+    return next((stream for stream in info.get("streams", []) if stream.get("codec_type") == "audio"), None)
+
+
+def _replace_audio(video_path: str, audio_path: str, output_path: str) -> None:
+    """
+    Puts the first audio track of `audio_path` under the video of `video_path`. The video stream
+    is copied as-is; the audio is copied when it is already AAC and converted otherwise. The
+    output keeps the video's duration.
+    """
+    audio_stream = _first_audio_stream(probe_video(audio_path))
+    audio_codec = ["-c:a", "copy"] if audio_stream and audio_stream.get("codec_name") == "aac" else ["-c:a", "aac"]
+    duration = probe_video(video_path)["format"]["duration"]
+    subprocess.run(
+        [FFMPEG_BINARY, "-y", "-i", video_path, "-i", audio_path, "-map", "0:v:0", "-map", "1:a:0",
+         "-c:v", "copy", *audio_codec, "-t", str(duration), "-movflags", "+faststart", output_path],
+        check=True, capture_output=True,
+    )
+
+
+def _evict_memoized_outputs() -> None:
+    """
+    Deletes the oldest memoized outputs once together they exceed MEMO_MAX_BYTES. Files this
+    process has handed out are kept, since a later step or the frontend may still read them.
+    """
+    entries = []
+    for path in OUTPUT_DIR.glob("*.mp4"):
+        if not _MEMO_NAME_RE.search(path.name):
+            continue
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, str(path)))
+    total = sum(size for _, size, _ in entries)
+    with _memo_lock:
+        in_use = set(_memo_handed_out)
+    for _, size, path in sorted(entries):
+        if total <= MEMO_MAX_BYTES:
+            break
+        if path in in_use:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        logger.info(f"Evicted memoized output: {path}")
+        total -= size
+
+
+def memoized_output(operation: str, source_paths: List[str], params: Dict, produce: Callable[[], str]) -> str:
+    """
+    Runs `produce` at most once per (operation, params, source file versions, encoder settings).
+    Its output is renamed to a content-addressed path in OUTPUT_DIR; later identical edits return
+    that file. Memoized outputs are evicted oldest-first beyond MEMO_MAX_BYTES.
+    """
+    try:
+        versions = [_probe_key(path) for path in source_paths]
+    except OSError:
+        return produce()
+    key = [operation, params, versions, video_encoder(), encoder_params()]
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    memo_path = str(OUTPUT_DIR / f"{Path(source_paths[0]).stem}_{operation}_{digest}.mp4")
+    with _memo_lock:
+        _memo_handed_out.add(memo_path)
+    if os.path.exists(memo_path) and os.path.getsize(memo_path) > 0:
+        logger.info(f"Reusing earlier output for {operation}: {memo_path}")
+        return memo_path
+
+    output_path = produce()
+    if output_path.lower().startswith("error:") or Path(output_path).suffix != ".mp4":
+        return output_path
+    os.replace(output_path, memo_path)
+    _evict_memoized_outputs()
+    return memo_path
+
+
+def _edited_duration(duration: float, tool_name: str, args: Dict) -> float:
+    """The duration of a video after applying a single-input edit to it."""
+    if tool_name == "trim_video":
+        end_time = duration if args.get("end_time") is None else float(args["end_time"])
+        return end_time - float(args["start_time"])
+    if tool_name == "change_video_speed":
+        return duration / float(args["speed_factor"])
+    return duration
+
+
+# Stream fields a trim, speed change or text overlay leaves unchanged.
+_DERIVED_STREAM_FIELDS = ("index", "codec_type", "width", "height", "r_frame_rate", "avg_frame_rate", "sample_rate", "channels")
+
+
+def prime_probe_cache(input_path: str, output_path: str, operations: List[Tuple[str, Dict]]) -> None:
+    """
+    Records the metadata of `output_path`, derived from its input and the edits that produced it,
+    so the next step working on it does not have to run ffprobe again.
+    """
+    if any(args.get("stream_copy") for _, args in operations):
+        # Stream-copied trims snap to keyframes, so the output duration isn't known here.
+        return
+    try:
+        info = probe_video(input_path)
+        duration = float(info["format"]["duration"])
+        for tool_name, args in operations:
+            duration = _edited_duration(duration, tool_name, args)
+        duration = str(duration)
+        # Only what the edit provably preserves is carried over. The output was re-encoded, so the
+        # input's codec, profile, pixel format, time base and bit rates say nothing about it.
+        derived = {
+            "format": {"filename": output_path, "duration": duration},
+            "streams": [
+                {**{field: stream[field] for field in _DERIVED_STREAM_FIELDS if field in stream}, "duration": duration}
+                for stream in info.get("streams", [])
+            ],
+        }
+        key = _probe_key(output_path)
+    except Exception as e:
+        # Priming is only an optimization; the output will be probed normally instead.
+        logger.debug(f"Could not prime probe cache for {output_path}: {e}")
+        return
+    with _derived_probes_lock:
+        _derived_probes[key] = derived
+        while len(_derived_probes) > _MAX_DERIVED_PROBES:
+            _derived_probes.popitem(last=False)
+
+
+def has_audio_stream(info: dict) -> bool:
+    """Whether probed media information contains an audio stream."""
+    return any(stream.get("codec_type") == "audio" for stream in info.get("streams", []))
+
+
+def _escape_filter_path(path: str) -> str:
+    """Escapes a file path for use as a quoted ffmpeg filter option."""
+    return path.replace("\\", "/").replace(":", "\\:")
+
+
+def _atempo_filters(speed_factor: float) -> List[str]:
+    """Splits a speed factor into atempo filters, each within atempo's [0.5, 2.0] range."""
+    if speed_factor <= 0:
+        raise ValueError(f"Speed factor must be positive, got {speed_factor}.")
+    filters = []
+    while speed_factor > 2.0:
+        filters.append("atempo=2.0")
+        speed_factor /= 2.0
+    while speed_factor < 0.5:
+        filters.append("atempo=0.5")
+        speed_factor /= 0.5
+    filters.append(f"atempo={speed_factor}")
+    return filters
+
+
+def _drawtext_filter(text_path: str, start_time: float, duration: float, position: str = "center", fontsize: int = 70, color: str = "white") -> str:
+    """
+    Builds a drawtext filter that shows the text stored in `text_path` for the given window.
+    `color` comes from the model, so it is checked before it goes into the filter string.
+    """
+    if not DRAWTEXT_COLOR_RE.fullmatch(color):
+        raise ValueError(f"Unsupported text color '{color}'.")
+    x, y = TEXT_POSITIONS.get(position, TEXT_POSITIONS["center"])
+    return (
+        f"drawtext=textfile='{_escape_filter_path(text_path)}':expansion=none"
+        f":fontsize={int(fontsize)}:fontcolor={color}:x={x}:y={y}"
+        f":enable='between(t,{start_time},{start_time + duration})'"
+    )
+
+
+def apply_fused_edits(video_path: str, operations: List[Tuple[str, Dict]]) -> str:
+    """
+    Applies a chain of single-input edits (trim, speed change, text overlay) in one
+    ffmpeg pass, so the video is decoded and encoded once instead of once per step.
+    `operations` holds (tool_name, tool_args) pairs in execution order.
+    """
+    logger.info(f"--- TOOL: apply_fused_edits starting ---")
+    text_files = []
+    try:
+        info = probe_video(video_path)
+        duration = float(info["format"]["duration"])
+
+        video_filters = []
+        audio_filters = []
+        for tool_name, args in operations:
+            if tool_name == "trim_video":
+                start_time = float(args["start_time"])
+                end_time = duration if args.get("end_time") is None else float(args["end_time"])
+                if start_time >= duration or end_time > duration:
+                    return f"Error: Invalid trim time. Start ({start_time}s) or end ({end_time}s) is beyond the video duration ({duration}s)."
+                video_filters += [f"trim=start={start_time}:end={end_time}", "setpts=PTS-STARTPTS"]
+                audio_filters += [f"atrim=start={start_time}:end={end_time}", "asetpts=PTS-STARTPTS"]
+            elif tool_name == "change_video_speed":
+                speed_factor = float(args["speed_factor"])
+                audio_filters += _atempo_filters(speed_factor)
+                video_filters.append(f"setpts=PTS/{speed_factor}")
+            elif tool_name == "add_text_to_video":
+                fd, text_path = tempfile.mkstemp(suffix=".txt")
+                text_files.append(text_path)
+                with os.fdopen(fd, "w", encoding="utf-8") as text_file:
+                    text_file.write(args["text"])
+                video_filters.append(_drawtext_filter(
+                    text_path, float(args["start_time"]), float(args["duration"]),
+                    position=args.get("position", "center"),
+                    fontsize=args.get("fontsize", 70),
+                    color=args.get("color", "white"),
+                ))
+            else:
+                raise ValueError(f"'{tool_name}' cannot be fused into a filter chain.")
+            duration = _edited_duration(duration, tool_name, args)
+
+        output_path = get_output_path(video_path, "edited")
+        command = [FFMPEG_BINARY, "-y", "-i", video_path, "-vf", ",".join(video_filters), "-c:v", video_encoder(), *encoder_params()]
+        if not has_audio_stream(info):
+            command.append("-an")
+        elif audio_filters:
+            command += ["-af", ",".join(audio_filters), "-c:a", "aac"]
+        else:
+            # Text overlays leave the audio untouched, so it can be copied as-is.
+            command += ["-c:a", "copy"]
+        command.append(output_path)
+
+        logger.info(f"Writing fused edit to: {output_path}")
+        subprocess.run(command, check=True, capture_output=True)
+
+        logger.info(f"--- TOOL: apply_fused_edits finished ---")
+        return output_path
+    except subprocess.CalledProcessError as e:
+        logger.error(f"ffmpeg failed in apply_fused_edits: {e.stderr.decode(errors='replace')}")
+        return "Error: An unexpected error occurred while applying the edits."
+    except Exception as e:
+        logger.error(f"An unexpected error occurred in apply_fused_edits: {e}")
+        return f"Error: An unexpected error occurred while applying the edits: {e}"
+    finally:
+        for text_path in text_files:
+            try:
+                os.remove(text_path)
+            except OSError:
+                pass
+
 @tool
-def trim_video(active_video_id: str, media_bin: Dict[str, str], start_time: float, end_time: Optional[float] = None) -> str:
+def trim_video(active_video_id: str, media_bin: Dict[str, str], start_time: float, end_time: Optional[float] = None, stream_copy: bool = False) -> str:
     """
     Trims a video to a specified start and end time.
+    With stream_copy, cut points within half a second of a keyframe are snapped to it and the video is not re-encoded.
     """
     logger.info(f"--- TOOL: trim_video starting ---")
     try:
         video_path = resolve_video_path(active_video_id, media_bin)
         logger.info(f"Resolved video path: {video_path}")
-        
-        with VideoFileClip(video_path) as clip:
-            # Validate end_time against the clip's duration
-            actual_end_time = end_time if end_time is not None else clip.duration
-            if start_time >= clip.duration or actual_end_time > clip.duration:
-                return f"Error: Invalid trim time. Start ({start_time}s) or end ({actual_end_time}s) is beyond the video duration ({clip.duration}s)."
 
+        info = probe_video(video_path)
+        duration = float(info["format"]["duration"])
+        actual_end_time = end_time if end_time is not None else duration
+        if start_time >= duration or actual_end_time > duration:
+            return f"Error: Invalid trim time. Start ({start_time}s) or end ({actual_end_time}s) is beyond the video duration ({duration}s)."
+        output_path = get_output_path(video_path, "trimmed")
+
+        if stream_copy:
+            cut = find_stream_copy_cut(video_path, start_time, end_time)
+            if cut is not None:
+                logger.info(f"Stream-copying trimmed video to: {output_path} (keyframes {cut})")
+                try:
+                    _stream_copy_trim(video_path, cut[0], cut[1], output_path)
+                    logger.info(f"--- TOOL: trim_video finished ---")
+                    return output_path
+                except subprocess.CalledProcessError as e:
+                    logger.warning(f"Stream-copy trim failed ({e.stderr.decode(errors='replace').strip()}); re-encoding.")
+            else:
+                logger.info("Trim points are not near keyframes; re-encoding.")
+
+        # Seeking before the input decodes only from the keyframe preceding the cut, and a
+        # re-encoded input seek is still frame-accurate.
+        command = [FFMPEG_BINARY, "-y", "-ss", str(start_time), "-to", str(actual_end_time), "-i", video_path,
+                   "-c:v", video_encoder(), *encoder_params()]
+        command += ["-c:a", "aac"] if has_audio_stream(info) else ["-an"]
+        logger.info(f"Writing trimmed video with ffmpeg to: {output_path}")
+        try:
+            subprocess.run(command + [output_path], check=True, capture_output=True)
+            logger.info(f"--- TOOL: trim_video finished ---")
+            return output_path
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"ffmpeg trim failed ({e.stderr.decode(errors='replace').strip()}); falling back to MoviePy.")
+
+        with _moviepy().VideoFileClip(video_path) as clip:
             subclip = clip.subclip(start_time, actual_end_time)
-            output_path = get_output_path(video_path, "trimmed")
-            
             logger.info(f"Writing trimmed video to: {output_path}")
-            subclip.write_videofile(output_path, codec="libx264", logger='bar')
+            _write_clip(subclip, output_path)
             
         logger.info(f"--- TOOL: trim_video finished ---")
         return output_path
@@ -75,33 +610,46 @@ def add_text_to_video(active_video_id: str, media_bin: Dict[str, str], text: str
     """
     logger.info(f"--- TOOL: add_text_to_video starting ---")
     try:
-        from moviepy.config import get_setting
-        if not get_setting("IMAGEMAGICK_BINARY"):
-            logger.error("ImageMagick is not installed or configured.")
-            return "Error: ImageMagick is not installed. Please install it to add text to videos."
-
         video_path = resolve_video_path(active_video_id, media_bin)
         logger.info(f"Resolved video path for text addition: {video_path}")
-        
-        with VideoFileClip(video_path) as clip:
+
+        # drawtext rasterizes the text inside the encoding pass, so there is no per-frame
+        # MoviePy composite unless ffmpeg fails.
+        info = probe_video(video_path)
+        output_path = get_output_path(video_path, "text_added")
+        fd, text_path = tempfile.mkstemp(suffix=".txt")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as text_file:
+                text_file.write(text)
+            video_filter = _drawtext_filter(text_path, start_time, duration, position=position, fontsize=fontsize, color=color)
+            command = [FFMPEG_BINARY, "-y", "-i", video_path, "-vf", video_filter, "-c:v", video_encoder(), *encoder_params()]
+            command += ["-c:a", "copy"] if has_audio_stream(info) else ["-an"]
+            logger.info(f"Writing video with text to: {output_path}")
+            subprocess.run(command + [output_path], check=True, capture_output=True)
+            logger.info(f"--- TOOL: add_text_to_video finished ---")
+            return output_path
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"ffmpeg drawtext failed ({e.stderr.decode(errors='replace').strip()}); falling back to MoviePy.")
+        finally:
+            os.remove(text_path)
+
+        with _moviepy().VideoFileClip(video_path) as clip:
             logger.info(f"Video clip for text addition loaded successfully. Duration: {clip.duration}s")
             
-            # Ensure the clip has a size, which is necessary for TextClip positioning
+            # Ensure the clip has a size, which is necessary for text positioning
             if clip.size is None:
                 raise ValueError("The video clip does not have a defined size.")
             
             logger.info(f"Clip size: {clip.size}")
 
-            text_clip = TextClip(txt=text, fontsize=fontsize, color=color, size=clip.size).set_position(position).set_start(start_time).set_duration(duration)
-            logger.info(f"Text clip created successfully.")
-
-            final_clip = CompositeVideoClip([clip, text_clip])
-            logger.info(f"Composite clip created successfully.")
-
-            output_path = get_output_path(video_path, "text_added")
+            # Blends the text into its bounding box during its window only, rather than
+            # compositing a full-frame layer over the whole clip.
+            final_clip = add_caption(clip, text, start_time, duration, fontsize=fontsize, color=color,
+                                     position=("center", position if position in ("top", "bottom") else "center"))
+            logger.info(f"Text overlay created successfully.")
 
             logger.info(f"Writing video with text to: {output_path}")
-            final_clip.write_videofile(output_path, codec="libx264", logger='bar')
+            _write_clip(final_clip, output_path)
             
         logger.info(f"--- TOOL: add_text_to_video finished ---")
         return output_path
@@ -127,13 +675,30 @@ def apply_filter_to_video(active_video_id: str, media_bin: Dict[str, str], filte
         parameters = filter_info.get("parameters", {})
         logger.info(f"Filter name: {filter_name}, Parameters: {parameters}")
 
-        with VideoFileClip(video_path) as clip:
+        # Most filters have an ffmpeg equivalent, which filters and encodes in one native pass.
+        # RGB filters would otherwise leave a 4:4:4 output that browsers can't play; encoder_params() pins yuv420p.
+        info = probe_video(video_path)
+        video_filter = ffmpeg_effect_filter(filter_name, float(info["format"]["duration"]), **parameters)
+        if video_filter is not None:
+            output_path = get_output_path(video_path, filter_name)
+            command = [FFMPEG_BINARY, "-y", "-i", video_path, "-vf", video_filter,
+                       "-c:v", video_encoder(), *encoder_params()]
+            command += ["-c:a", "copy"] if has_audio_stream(info) else ["-an"]
+            logger.info(f"Writing filtered video with ffmpeg ({video_filter}) to: {output_path}")
+            try:
+                subprocess.run(command + [output_path], check=True, capture_output=True)
+                logger.info(f"--- TOOL: apply_filter_to_video finished ---")
+                return output_path
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"ffmpeg filter failed ({e.stderr.decode(errors='replace').strip()}); falling back to MoviePy.")
+
+        with _moviepy().VideoFileClip(video_path) as clip:
             # Use the robust apply_effects function
             final_clip = apply_effects(clip, filter_name, **parameters)
             
             output_path = get_output_path(video_path, filter_name)
             logger.info(f"Writing filtered video to: {output_path}")
-            final_clip.write_videofile(output_path, codec="libx264", logger='bar')
+            _write_clip(final_clip, output_path)
             
         logger.info(f"--- TOOL: apply_filter_to_video finished ---")
         return output_path
@@ -157,12 +722,27 @@ def change_video_speed(active_video_id: str, media_bin: Dict[str, str], speed_fa
         video_path = resolve_video_path(active_video_id, media_bin)
         logger.info(f"Resolved video path: {video_path}")
         
-        with VideoFileClip(video_path) as clip:
+        # setpts/atempo retime in a single native pass instead of resampling frames in MoviePy.
+        info = probe_video(video_path)
+        output_path = get_output_path(video_path, f"speed_{speed_factor}x")
+        command = [FFMPEG_BINARY, "-y", "-i", video_path, "-vf", f"setpts=PTS/{speed_factor}",
+                   "-c:v", video_encoder(), *encoder_params()]
+        if has_audio_stream(info):
+            command += ["-af", ",".join(_atempo_filters(speed_factor)), "-c:a", "aac"]
+        else:
+            command.append("-an")
+        logger.info(f"Writing speed-adjusted video with ffmpeg to: {output_path}")
+        try:
+            subprocess.run(command + [output_path], check=True, capture_output=True)
+            logger.info(f"--- TOOL: change_video_speed finished ---")
+            return output_path
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"ffmpeg speed change failed ({e.stderr.decode(errors='replace').strip()}); falling back to MoviePy.")
+
+        with _moviepy().VideoFileClip(video_path) as clip:
             final_clip = clip.speedx(speed_factor)
-            output_path = get_output_path(video_path, f"speed_{speed_factor}x")
-            
             logger.info(f"Writing speed-adjusted video to: {output_path}")
-            final_clip.write_videofile(output_path, codec="libx264", logger='bar')
+            _write_clip(final_clip, output_path)
             
         logger.info(f"--- TOOL: change_video_speed finished ---")
         return output_path
@@ -173,36 +753,45 @@ def change_video_speed(active_video_id: str, media_bin: Dict[str, str], speed_fa
 @tool
 def extract_audio(active_video_id: str, media_bin: Dict[str, str]) -> str:
     """
-    Extracts the audio track from a video and saves it as an MP3 file.
+    Extracts the audio track from a video, copying AAC as-is into an M4A file and
+    converting anything else to MP3. The video stream is never decoded.
     It adds the new audio file to the media bin.
     It returns a JSON string containing the new 'audio_id' and its 'output_path'.
     """
     logger.info(f"--- TOOL: extract_audio starting ---")
     video_path = resolve_video_path(active_video_id, media_bin)
     logger.info(f"Resolved video path: {video_path}")
-    
-    with VideoFileClip(video_path) as clip:
-        if clip.audio is None:
-            raise ValueError("The video does not have an audio track.")
-        
-        # 1. Generate a unique ID and path for the new audio file
-        audio_id = str(uuid.uuid4())
+
+    audio_stream = _first_audio_stream(probe_video(video_path))
+    if audio_stream is None:
+        raise ValueError("The video does not have an audio track.")
+
+    # 1. Generate a unique ID and path for the new audio file
+    audio_id = str(uuid.uuid4())
+    if audio_stream.get("codec_name") == "aac":
+        output_path = get_output_path(video_path, "extracted_audio", extension="m4a")
+        audio_codec = ["-c:a", "copy"]
+    else:
         output_path = get_output_path(video_path, "extracted_audio", extension="mp3")
-        
-        logger.info(f"Writing extracted audio to: {output_path}")
-        clip.audio.write_audiofile(output_path, logger='bar')
-        
-        # 2. Add the new audio file to the media bin
-        # NOTE: This modifies the dictionary in-place.
-        media_bin[audio_id] = output_path
-        logger.info(f"Added new audio '{audio_id}' to media bin.")
-        
+        audio_codec = ["-c:a", "libmp3lame", "-q:a", "2"]
+
+    logger.info(f"Writing extracted audio to: {output_path}")
+    subprocess.run(
+        [FFMPEG_BINARY, "-y", "-i", video_path, "-map", "0:a:0", "-vn", *audio_codec, output_path],
+        check=True, capture_output=True,
+    )
+
+    # 2. Add the new audio file to the media bin
+    # NOTE: This modifies the dictionary in-place.
+    media_bin[audio_id] = output_path
+    logger.info(f"Added new audio '{audio_id}' to media bin.")
+
     logger.info(f"--- TOOL: extract_audio finished ---")
     # 3. Return both the ID and path for robust handling
-    return json.dumps({
+    return orjson.dumps({
         "audio_id": audio_id,
         "output_path": output_path
-    })
+    }).decode()
 
 @tool
 def add_audio_to_video(video_id: str, audio_id: str, media_bin: Dict[str, str]) -> str:
@@ -229,16 +818,24 @@ def add_audio_to_video(video_id: str, audio_id: str, media_bin: Dict[str, str])
     
     logger.info(f"Video path: {video_path}")
     logger.info(f"Audio path: {audio_path}")
-    
-    with VideoFileClip(video_path) as video_clip:
-        with AudioFileClip(audio_path) as audio_clip:
+
+    output_path = get_output_path(video_path, "with_audio")
+    try:
+        logger.info(f"Muxing new audio under the original video stream to: {output_path}")
+        _replace_audio(video_path, audio_path, output_path)
+        logger.info(f"--- TOOL: add_audio_to_video finished ---")
+        return output_path
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"ffmpeg remux failed ({e.stderr.decode(errors='replace').strip()}); re-encoding with MoviePy.")
+
+    editor = _moviepy()
+    with editor.VideoFileClip(video_path) as video_clip:
+        with editor.AudioFileClip(audio_path) as audio_clip:
             # Set the audio of the video clip
             final_clip = video_clip.set_audio(audio_clip)
             
-            output_path = get_output_path(video_path, "with_audio")
-            
             logger.info(f"Writing video with new audio to: {output_path}")
-            final_clip.write_videofile(output_path, codec="libx264", audio_codec="aac", logger='bar')
+            _write_clip(final_clip, output_path)
     
     logger.info(f"--- TOOL: add_audio_to_video finished ---")
     return output_path
@@ -256,14 +853,70 @@ def concatenate_videos(video_ids: List[str], media_bin: Dict[str, str]) -> str:
 
     moviepy_clips = [] # Define here to be accessible in finally block
     try:
-        video_paths = [media_bin.get(vid_id) for vid_id in video_ids]
-        if not all(video_paths):
-            missing_ids = [vid_id for vid_id, path in zip(video_ids, video_paths) if not path]
+        missing_ids = [vid_id for vid_id in video_ids if not media_bin.get(vid_id)]
+        if missing_ids:
             raise ValueError(f"Could not find video paths for the following IDs: {missing_ids}")
+        video_paths = [media_bin[vid_id] for vid_id in video_ids]
 
         logger.info(f"Resolved video paths: {video_paths}")
-        
-        moviepy_clips = [VideoFileClip(path) for path in video_paths]
+
+        # Inputs with the same codecs, raster and frame rate can be joined packet for packet.
+        if len({_stream_signature(path) for path in video_paths}) == 1:
+            output_path = get_output_path(video_paths[0], "concatenated")
+            try:
+                logger.info(f"Stream-copying concatenated video to: {output_path}")
+                _stream_copy_concat(video_paths, output_path)
+                logger.info(f"--- TOOL: concatenate_videos finished ---")
+                return output_path
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"Stream-copy concatenation failed ({e.stderr.decode(errors='replace').strip()}); re-encoding.")
+
+        # Otherwise normalize each input with ffmpeg (padded to the largest frame, the first clip's
+        # frame rate, one audio format) and join the normalized segments packet for packet.
+        # A video listed more than once is normalized once and its segment repeated.
+        unique_paths = list(dict.fromkeys(video_paths))
+        infos = [probe_video(path) for path in unique_paths]
+        video_streams = [next(stream for stream in info["streams"] if stream.get("codec_type") == "video") for info in infos]
+        # Rounded up to even dimensions, which yuv420p requires.
+        max_width = max(stream["width"] for stream in video_streams)
+        max_height = max(stream["height"] for stream in video_streams)
+        target_size = ((max_width + 1) // 2 * 2, (max_height + 1) // 2 * 2)
+        fps = video_streams[0].get("r_frame_rate")
+        if not fps or fps.startswith("0/"):
+            fps = "24"
+        with_audio = any(has_audio_stream(info) for info in infos)
+        output_path = get_output_path(video_paths[0], "concatenated")
+        try:
+            with tempfile.TemporaryDirectory() as segment_dir:
+                segments = {path: os.path.join(segment_dir, f"{index}.mp4") for index, path in enumerate(unique_paths)}
+                logger.info(f"Normalizing {len(unique_paths)} clips to {target_size} at {fps} fps for concatenation.")
+                # Each job runs in a copy of this thread's context so settings such as
+                # intermediate_encoding() apply to the normalize encodes too.
+                jobs = [(contextvars.copy_context(), path, info) for path, info in zip(unique_paths, infos)]
+                # The caller's permit covers one encode; each further worker needs a spare one.
+                extra_permits = 0
+                while (extra_permits < min(len(unique_paths), CONCAT_NORMALIZE_WORKERS) - 1
+                       and EDIT_SEMAPHORE.acquire(blocking=False)):
+                    extra_permits += 1
+                try:
+                    with ThreadPoolExecutor(max_workers=1 + extra_permits) as pool:
+                        # list() re-raises the first ffmpeg failure here.
+                        list(pool.map(
+                            lambda job: job[0].run(_normalize_for_concat, job[1], job[2], target_size, fps, with_audio, segments[job[1]]),
+                            jobs,
+                        ))
+                finally:
+                    for _ in range(extra_permits):
+                        EDIT_SEMAPHORE.release()
+                _stream_copy_concat([segments[path] for path in video_paths], output_path)
+            logger.info(f"--- TOOL: concatenate_videos finished ---")
+            return output_path
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"ffmpeg concatenation failed ({e.stderr.decode(errors='replace').strip()}); falling back to MoviePy.")
+
+        # One reader per distinct file; a repeated clip is rendered again by seeking the same reader.
+        clips_by_path = {path: _moviepy().VideoFileClip(path) for path in dict.fromkeys(video_paths)}
+        moviepy_clips = [clips_by_path[path] for path in video_paths]
         
         # --- FIX: Standardize FPS to prevent 'video_fps' KeyError ---
         # Use the FPS of the first clip as the target for all clips.
@@ -293,7 +946,8 @@ def concatenate_videos(video_ids: List[str], media_bin: Dict[str, str]) -> str:
             logger.info(f"Clips have different resolutions. Resizing and padding to target {target_size}.")
             for clip in moviepy_clips:
                 if clip.size != target_size:
-                    padded_clip = CompositeVideoClip([ColorClip(size=target_size, color=(0,0,0), duration=clip.duration), clip.set_position('center')])
+                    editor = _moviepy()
+                    padded_clip = editor.CompositeVideoClip([editor.ColorClip(size=target_size, color=(0,0,0), duration=clip.duration), clip.set_position('center')])
                     processed_clips.append(padded_clip)
                 else:
                     processed_clips.append(clip)
@@ -303,9 +957,8 @@ def concatenate_videos(video_ids: List[str], media_bin: Dict[str, str]) -> str:
 
         output_path = get_output_path(video_paths[0], "concatenated")
         logger.info(f"Writing concatenated video to: {output_path}")
-        final_clip = concatenate_videoclips(processed_clips, method="compose")
-        # Added performance flags: preset='ultrafast' and threads=8
-        final_clip.write_videofile(output_path, codec="libx264", logger='bar', preset='ultrafast', threads=8)
+        final_clip = _moviepy().concatenate_videoclips(processed_clips, method="compose")
+        _write_clip(final_clip, output_path)
         
         logger.info(f"--- TOOL: concatenate_videos finished ---")
         return output_path
@@ -314,8 +967,8 @@ def concatenate_videos(video_ids: List[str], media_bin: Dict[str, str]) -> str:
         logger.error(f"Error during video concatenation: {e}")
         return f"Error: An unexpected error occurred during video concatenation: {e}"
     finally:
-        # Clean up all original video file clips
-        for clip in moviepy_clips:
+        # Clean up all original video file clips, closing shared ones once
+        for clip in set(moviepy_clips):
             clip.close()
         if 'final_clip' in locals() and 'final_clip' is not None:
             final_clip.close()
@@ -335,18 +988,26 @@ def extract_and_add_audio(source_video_id: str, destination_video_id: str, media
         logger.info(f"Resolved source path: {source_path}")
         logger.info(f"Resolved destination path: {destination_path}")
 
-        # 2. Perform the combined operation
-        with VideoFileClip(source_path) as source_clip, VideoFileClip(destination_path) as dest_clip:
-            if source_clip.audio is None:
-                raise ValueError(f"The source video ('{source_video_id}') has no audio track to extract.")
-            
+        if _first_audio_stream(probe_video(source_path)) is None:
+            raise ValueError(f"The source video ('{source_video_id}') has no audio track to extract.")
+        output_path = get_output_path(destination_path, "audio_swapped")
+
+        # 2. Perform the combined operation: one remux, with the destination's video stream copied
+        try:
+            logger.info(f"Muxing source audio under the destination video to: {output_path}")
+            _replace_audio(destination_path, source_path, output_path)
+            logger.info(f"--- TOOL: extract_and_add_audio finished ---")
+            return output_path
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"ffmpeg remux failed ({e.stderr.decode(errors='replace').strip()}); re-encoding with MoviePy.")
+
+        editor = _moviepy()
+        with editor.VideoFileClip(source_path) as source_clip, editor.VideoFileClip(destination_path) as dest_clip:
             # Set the destination clip's audio to the source clip's audio
             final_clip = dest_clip.set_audio(source_clip.audio)
-            
-            output_path = get_output_path(destination_path, "audio_swapped")
-            
+
             logger.info(f"Writing final video to: {output_path}")
-            final_clip.write_videofile(output_path, codec="libx264", audio_codec="aac", logger='bar')
+            _write_clip(final_clip, output_path)
 
         logger.info(f"--- TOOL: extract_and_add_audio finished ---")
         return output_path